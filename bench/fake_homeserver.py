@@ -0,0 +1,510 @@
+##
+# A stand-in matrix homeserver for benchmarking the backend.
+#
+# It only knows enough of the client-server API for the backend to start up, sync, and send replies:
+# whoami, sync, send, profile, upload, event, members, joined_rooms, m.direct, filters and (just enough
+# of) the e2ee key endpoints. It can also push events to the bot as an application service. Everything is
+# kept in memory and every request can be slowed down by a fixed latency to make it look like a real server.
+##
+
+import time
+import json
+import asyncio
+import fnmatch
+import itertools
+import threading
+
+from aiohttp import web, ClientSession, ClientError
+
+CLIENT = "/_matrix/client/{version}/"
+MEDIA = "/_matrix/media/{version}/"
+
+
+class FakeHomeserver(object):
+    """An in-process homeserver with `rooms` rooms of `members` members each.
+
+    Use `inject` to have someone say something in a room, the bot will see it on its next sync. Anything
+    the bot sends is recorded in `sent`, along with when we got it.
+
+    With `encrypted` the rooms are marked as encrypted, so the bot has to encrypt everything it sends.
+    Nobody else has any devices, so there's nobody to share keys with, but the bot still does all the
+    Megolm work.
+
+    Like a real homeserver, people talking also generates typing notifications, read receipts and
+    presence. Sync filters (uploaded or not) are applied to those, the room timeline and state.
+
+    After `push_to`, events go to an application service in transactions rather than out through sync.
+    With `duplicates` each transaction is sent twice, like a homeserver retrying one it thinks failed.
+    """
+
+    def __init__(
+        self,
+        rooms: int = 10,
+        members: int = 5,
+        latency: float = 0.0,
+        user_id: str = "@bot:localhost",
+        encrypted: bool = False,
+    ):
+        self.user_id = user_id
+        self.latency = latency
+        self.encrypted = encrypted
+        self.rooms = ["!room{}:localhost".format(i) for i in range(rooms)]
+        self.members = ["@user{}:localhost".format(i) for i in range(members)]
+
+        self.sent = []
+        self.requests = dict()
+        self.syncs = 0
+        self.failing_syncs = 0
+        self.first_incremental_sync = None
+
+        self.joins = dict()
+        self.one_time_keys = 0
+        self.to_device = 0
+
+        self.appservice = None
+        self.duplicates = False
+        self.transactions = 0
+        self._outgoing = []
+        self._pushing = None
+
+        self._events = dict()
+        self._filters = dict()
+        self._pending = []
+        self._invites = []
+        self._new_rooms = []
+        self._ids = itertools.count()
+        self._wakeup = None
+        self._loop = None
+        self._runner = None
+        self.port = None
+
+    ##
+    # Running the server
+    ##
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """Start the server on its own thread, returns the port it's listening on."""
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start(host, port))
+            ready.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, name="fake-homeserver", daemon=True).start()
+        ready.wait()
+        return self.port
+
+    async def _start(self, host: str, port: int) -> None:
+        self._wakeup = asyncio.Event()
+
+        app = web.Application(middlewares=[self._slow_down])
+        app.router.add_get(CLIENT + "account/whoami", self.whoami)
+        app.router.add_get(CLIENT + "sync", self.sync)
+        app.router.add_put(CLIENT + "rooms/{room}/send/{type}/{txn}", self.send)
+        app.router.add_get(CLIENT + "rooms/{room}/event/{event}", self.get_event)
+        app.router.add_get(
+            CLIENT + "rooms/{room}/state/m.room.member/{user}", self.get_member
+        )
+        app.router.add_get(CLIENT + "rooms/{room}/joined_members", self.joined_members)
+        app.router.add_get(CLIENT + "rooms/{room}/state", self.get_state)
+        app.router.add_get(CLIENT + "profile/{user}", self.profile)
+        app.router.add_get(CLIENT + "joined_rooms", self.joined_rooms)
+        app.router.add_get(CLIENT + "user/{user}/account_data/{type}", self.not_found)
+        app.router.add_post(CLIENT + "user/{user}/filter", self.filter)
+        app.router.add_post(CLIENT + "join/{room}", self.join)
+        app.router.add_post(CLIENT + "keys/upload", self.keys_upload)
+        app.router.add_post(CLIENT + "keys/query", self.keys_query)
+        app.router.add_post(CLIENT + "keys/claim", self.keys_claim)
+        app.router.add_put(CLIENT + "sendToDevice/{type}/{txn}", self.send_to_device)
+        app.router.add_post(MEDIA + "upload", self.upload)
+        app.router.add_post("/_matrix/client/v1/media/upload", self.upload)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    @web.middleware
+    async def _slow_down(self, request, handler):
+        name = handler.__name__
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    ##
+    # Driving it
+    ##
+
+    def inject(self, room_id: str, sender: str, body: str) -> str:
+        """Have sender say body in room_id. Safe to call from any thread."""
+        event = {
+            "type": "m.room.message",
+            "sender": sender,
+            "event_id": "$event{}".format(next(self._ids)),
+            "origin_server_ts": int(time.time() * 1000),
+            "content": {"msgtype": "m.text", "body": body},
+        }
+        self._loop.call_soon_threadsafe(self._add_event, room_id, event)
+        return event["event_id"]
+
+    def _add_event(self, room_id: str, event: dict) -> None:
+        self._events[event["event_id"]] = event
+        if self.appservice:
+            return self._push(dict(event, room_id=room_id))
+        self._pending.append((room_id, event))
+        self._wakeup.set()
+
+    def invite(self, room_id: str, inviter: str) -> None:
+        """Have inviter invite the bot to room_id. Safe to call from any thread."""
+        self._loop.call_soon_threadsafe(self._add_invite, room_id, inviter)
+
+    def _add_invite(self, room_id: str, inviter: str) -> None:
+        if self.appservice:
+            event = dict(self._invite_state(room_id, inviter)[-1])
+            event.update(
+                room_id=room_id,
+                event_id="$invite{}".format(next(self._ids)),
+                origin_server_ts=int(time.time() * 1000),
+                unsigned={"invite_room_state": self._invite_state(room_id, inviter)},
+            )
+            return self._push(event)
+        self._invites.append((room_id, inviter))
+        self._wakeup.set()
+
+    def push_to(self, url: str, hs_token: str, duplicates: bool = False) -> None:
+        """Send events to an application service at url, rather than with sync."""
+        self.appservice = (url, hs_token)
+        self.duplicates = duplicates
+
+    def _push(self, event: dict) -> None:
+        self._outgoing.append(event)
+        if self._pushing is None or self._pushing.done():
+            self._pushing = asyncio.ensure_future(self._push_transactions())
+
+    async def _push_transactions(self) -> None:
+        """Send whatever is waiting as a transaction, one at a time, retrying until it's accepted."""
+        url, hs_token = self.appservice
+        headers = {"Authorization": "Bearer " + hs_token}
+        async with ClientSession() as session:
+            while self._outgoing:
+                events, self._outgoing = self._outgoing, []
+                path = "{}/_matrix/app/v1/transactions/txn{}".format(
+                    url, next(self._ids)
+                )
+                for _ in range(2 if self.duplicates else 1):
+                    while True:
+                        try:
+                            async with session.put(
+                                path, json={"events": events}, headers=headers
+                            ) as response:
+                                if response.status == 200:
+                                    break
+                        except ClientError:
+                            pass
+                        await asyncio.sleep(0.1)
+                    self.transactions += 1
+
+    ##
+    # The API
+    ##
+
+    def _member(self, room_id: str, user_id: str) -> dict:
+        return {
+            "type": "m.room.member",
+            "sender": user_id,
+            "state_key": user_id,
+            "event_id": "$member-{}-{}".format(room_id, user_id),
+            "origin_server_ts": 0,
+            "content": {"membership": "join", "displayname": user_id[1:].split(":")[0]},
+        }
+
+    def _invite_state(self, room_id: str, inviter: str) -> list:
+        return [
+            {
+                "type": "m.room.name",
+                "sender": inviter,
+                "state_key": "",
+                "content": {"name": "Room " + room_id},
+            },
+            {
+                "type": "m.room.member",
+                "sender": inviter,
+                "state_key": self.user_id,
+                "content": {"membership": "invite"},
+            },
+        ]
+
+    def _joined_room(self, room_id: str, lazy: bool) -> dict:
+        return {
+            "state": {"events": self._room_state(room_id, lazy)},
+            "timeline": {"events": [], "limited": False},
+            "summary": {
+                "m.joined_member_count": len(self.members) + 1,
+                "m.invited_member_count": 0,
+                "m.heroes": self.members[:5],
+            },
+        }
+
+    def _room_state(self, room_id: str, lazy: bool) -> list:
+        state = [
+            {
+                "type": "m.room.create",
+                "sender": self.user_id,
+                "state_key": "",
+                "event_id": "$create-" + room_id,
+                "origin_server_ts": 0,
+                "content": {"creator": self.user_id},
+            },
+            {
+                "type": "m.room.name",
+                "sender": self.user_id,
+                "state_key": "",
+                "event_id": "$name-" + room_id,
+                "origin_server_ts": 0,
+                "content": {"name": "Room " + room_id},
+            },
+            self._member(room_id, self.user_id),
+        ]
+        if self.encrypted:
+            state.append(
+                {
+                    "type": "m.room.encryption",
+                    "sender": self.user_id,
+                    "state_key": "",
+                    "event_id": "$encryption-" + room_id,
+                    "origin_server_ts": 0,
+                    "content": {"algorithm": "m.megolm.v1.aes-sha2"},
+                }
+            )
+        if not lazy:
+            state.extend(self._member(room_id, user) for user in self.members)
+        return state
+
+    def _sync_filter(self, request) -> dict:
+        sync_filter = request.query.get("filter", "")
+        if sync_filter.startswith("{"):
+            return json.loads(sync_filter)
+        return self._filters.get(sync_filter, {})
+
+    @staticmethod
+    def _wanted(event_filter: dict, event_type: str) -> bool:
+        """Does an EventFilter (types/not_types, with * wildcards) let this type through?"""
+        if any(
+            fnmatch.fnmatch(event_type, t) for t in event_filter.get("not_types", ())
+        ):
+            return False
+        types = event_filter.get("types")
+        return types is None or any(fnmatch.fnmatch(event_type, t) for t in types)
+
+    @classmethod
+    def _apply(cls, event_filter: dict, events: list) -> list:
+        return [event for event in events if cls._wanted(event_filter, event["type"])]
+
+    def _chatter(self, room_id: str, event: dict) -> dict:
+        """The typing, receipt and presence events that go with someone saying something."""
+        sender = event["sender"]
+        ephemeral = [
+            {"type": "m.typing", "content": {"user_ids": [sender]}},
+            {
+                "type": "m.receipt",
+                "content": {
+                    event["event_id"]: {
+                        "m.read": {user: {"ts": event["origin_server_ts"]}}
+                        for user in self.members[:5] + [sender]
+                    }
+                },
+            },
+        ]
+        presence = {
+            "type": "m.presence",
+            "sender": sender,
+            "content": {"presence": "online", "currently_active": True},
+        }
+        return {"ephemeral": ephemeral, "presence": presence}
+
+    @staticmethod
+    def _empty_sync(next_batch: str) -> dict:
+        return {
+            "next_batch": next_batch,
+            "rooms": {"join": {}, "invite": {}, "leave": {}},
+            "presence": {"events": []},
+            "account_data": {"events": []},
+            "to_device": {"events": []},
+        }
+
+    async def sync(self, request):
+        self.syncs += 1
+        since = request.query.get("since")
+        timeout = int(request.query.get("timeout", 0)) / 1000
+        sync_filter = self._sync_filter(request)
+        room_filter = sync_filter.get("room", {})
+        lazy = room_filter.get("state", {}).get("lazy_load_members", False)
+
+        if not since:
+            body = self._empty_sync("s0")
+            for room_id in self.rooms:
+                body["rooms"]["join"][room_id] = self._joined_room(room_id, lazy)
+            return self._filtered(body, sync_filter)
+
+        if self.first_incremental_sync is None:
+            self.first_incremental_sync = time.monotonic()
+
+        # pretend to be having a bad time
+        if self.failing_syncs:
+            self.failing_syncs -= 1
+            return web.json_response(
+                {"errcode": "M_UNKNOWN", "error": "try again later"}, status=502
+            )
+
+        if not (self._pending or self._invites or self._new_rooms) and timeout:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        pending, self._pending = self._pending, []
+        body = self._empty_sync("s{}".format(next(self._ids)))
+
+        invites, self._invites = self._invites, []
+        for room_id, inviter in invites:
+            body["rooms"]["invite"][room_id] = {
+                "invite_state": {"events": self._invite_state(room_id, inviter)}
+            }
+
+        new_rooms, self._new_rooms = self._new_rooms, []
+        for room_id in new_rooms:
+            body["rooms"]["join"][room_id] = self._joined_room(room_id, lazy)
+
+        for room_id, event in pending:
+            room = body["rooms"]["join"].setdefault(
+                room_id,
+                {
+                    "state": {"events": []},
+                    "timeline": {"events": [], "limited": False},
+                    "ephemeral": {"events": []},
+                },
+            )
+            room["timeline"]["events"].append(event)
+            # lazy loading still sends the members of anyone in the timeline
+            if lazy:
+                room["state"]["events"].append(self._member(room_id, event["sender"]))
+
+            chatter = self._chatter(room_id, event)
+            room.setdefault("ephemeral", {"events": []})
+            room["ephemeral"]["events"].extend(chatter["ephemeral"])
+            body["presence"]["events"].append(chatter["presence"])
+        return self._filtered(body, sync_filter)
+
+    def _filtered(self, body: dict, sync_filter: dict):
+        room_filter = sync_filter.get("room", {})
+        body["presence"]["events"] = self._apply(
+            sync_filter.get("presence", {}), body["presence"]["events"]
+        )
+        for room in body["rooms"]["join"].values():
+            for section in ("state", "timeline", "ephemeral"):
+                if section in room:
+                    room[section]["events"] = self._apply(
+                        room_filter.get(section, {}), room[section]["events"]
+                    )
+        return web.json_response(body)
+
+    async def send(self, request):
+        content = await request.json()
+        event_id = "$sent{}".format(next(self._ids))
+        self.sent.append(
+            (
+                time.monotonic(),
+                request.match_info["room"],
+                request.match_info["type"],
+                content,
+            )
+        )
+        return web.json_response({"event_id": event_id})
+
+    async def get_event(self, request):
+        event = self._events.get(request.match_info["event"])
+        if not event:
+            return await self.not_found(request)
+        return web.json_response(event)
+
+    async def get_member(self, request):
+        user = request.match_info["user"]
+        if user != self.user_id and user not in self.members:
+            return await self.not_found(request)
+        return web.json_response(
+            self._member(request.match_info["room"], user)["content"]
+        )
+
+    async def get_state(self, request):
+        return web.json_response(self._room_state(request.match_info["room"], False))
+
+    async def joined_members(self, request):
+        members = {
+            user: {"display_name": user[1:].split(":")[0], "avatar_url": None}
+            for user in [self.user_id] + self.members
+        }
+        return web.json_response({"joined": members})
+
+    async def profile(self, request):
+        user = request.match_info["user"]
+        return web.json_response({"displayname": user[1:].split(":")[0]})
+
+    async def whoami(self, request):
+        return web.json_response({"user_id": self.user_id, "device_id": "BENCH"})
+
+    async def joined_rooms(self, request):
+        return web.json_response({"joined_rooms": self.rooms})
+
+    async def join(self, request):
+        room_id = request.match_info["room"]
+        self.joins[room_id] = self.joins.get(room_id, 0) + 1
+        if room_id not in self.rooms:
+            self.rooms.append(room_id)
+            if self.appservice:
+                self._push(dict(self._member(room_id, self.user_id), room_id=room_id))
+            else:
+                self._new_rooms.append(room_id)
+                self._wakeup.set()
+        return web.json_response({"room_id": room_id})
+
+    async def keys_upload(self, request):
+        body = await request.json()
+        self.one_time_keys += len(body.get("one_time_keys", {}))
+        return web.json_response(
+            {"one_time_key_counts": {"signed_curve25519": self.one_time_keys}}
+        )
+
+    async def keys_query(self, request):
+        body = await request.json()
+        devices = {user: {} for user in body.get("device_keys", {})}
+        return web.json_response({"device_keys": devices, "failures": {}})
+
+    async def keys_claim(self, request):
+        return web.json_response({"one_time_keys": {}, "failures": {}})
+
+    async def send_to_device(self, request):
+        await request.read()
+        self.to_device += 1
+        return web.json_response({})
+
+    async def filter(self, request):
+        filter_id = str(len(self._filters) + 1)
+        self._filters[filter_id] = await request.json()
+        return web.json_response({"filter_id": filter_id})
+
+    async def upload(self, request):
+        await request.read()
+        return web.json_response(
+            {"content_uri": "mxc://localhost/{}".format(next(self._ids))}
+        )
+
+    async def not_found(self, request):
+        return web.json_response(
+            {"errcode": "M_NOT_FOUND", "error": "not found"}, status=404
+        )
@@ -0,0 +1,291 @@
+##
+# End to end benchmark for the matrix backend.
+#
+# Starts a fake homeserver, boots errbot with this backend pointed at it, and fires `!echo` commands
+# into the rooms. We time how long it takes to get through the initial sync, how long each command
+# takes to come back, and how much memory the whole thing needed.
+#
+#   python bench/run_bench.py --rooms 500 --messages 2000 --latency 0.005
+#
+# With --encrypted the rooms are encrypted and the bot runs with MATRIX_E2EE, so comparing the two runs
+# gives the startup and per-message cost of the crypto (this needs `pip install matrix-nio[e2e]`).
+# With --appservice the bot runs as an application service and the homeserver pushes events to it.
+#
+# Nothing leaves the machine, so it's fine to run in CI.
+##
+
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import resource
+import socket
+import tempfile
+import threading
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from fake_homeserver import FakeHomeserver  # noqa: E402
+
+log = logging.getLogger("bench")
+
+# each command's reply contains its token. With MATRIX_COALESCE_WINDOW several replies can go out as one
+# event, so we look for the tokens anywhere in what was sent rather than matching whole bodies
+TOKEN = re.compile(r"\bbench-\d+\b")
+
+
+def make_config(port: int, data_dir: str, **settings) -> SimpleNamespace:
+    config = SimpleNamespace(
+        BACKEND="Matrix",
+        BOT_IDENTITY={"homeserver": "http://127.0.0.1:{}".format(port), "token": "x"},
+        BOT_ADMINS=("@admin:localhost",),
+        BOT_DATA_DIR=data_dir,
+        BOT_EXTRA_PLUGIN_DIR=None,
+        BOT_EXTRA_BACKEND_DIR=os.path.dirname(HERE),
+        BOT_LOG_FILE=None,
+        BOT_LOG_LEVEL=logging.WARNING,
+        BOT_LOG_SENTRY=False,
+        BOT_PREFIX="!",
+        AUTOINSTALL_DEPS=False,
+        SUPPRESS_CMD_NOT_FOUND=True,
+    )
+    for key, value in settings.items():
+        setattr(config, key, value)
+    return config
+
+
+def start_bot(config):
+    """Boot errbot with our config and run the backend on its own thread."""
+    from errbot.bootstrap import setup_bot
+
+    bot = setup_bot("Matrix", logging.getLogger(), config)
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        bot.serve_once()
+
+    threading.Thread(target=run, name="errbot", daemon=True).start()
+    return bot
+
+
+def wait_for(predicate, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def peak_rss_mb() -> float:
+    # linux reports kilobytes, macOS bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def wrappers_made(bot) -> int:
+    """How many room/occupant wrappers the backend has had to make so far."""
+    return bot._async.cache_stats()["identity"]["misses"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def plaintext(bot, room_id: str, kind: str, content: dict) -> dict:
+    """The content of something the bot sent, decrypting it (with the bot's own keys) if need be."""
+    if kind != "m.room.encrypted":
+        return content
+
+    import nio
+
+    event = nio.events.room_events.MegolmEvent.from_dict(
+        {
+            "type": kind,
+            "content": content,
+            "sender": bot._client.user_id,
+            "event_id": "$bench-{}".format(content["ciphertext"][:16]),
+            "origin_server_ts": 0,
+            "room_id": room_id,
+        }
+    )
+    return bot._client.decrypt_event(event).source["content"]
+
+
+def run(args) -> dict:
+    server = FakeHomeserver(
+        rooms=args.rooms,
+        members=args.members,
+        latency=args.latency,
+        encrypted=args.encrypted,
+    )
+    port = server.start()
+
+    data_dir = tempfile.mkdtemp(prefix="errmatrix-bench-")
+    settings = dict(setting.split("=", 1) for setting in args.set)
+    settings = {key: json.loads(value) for key, value in settings.items()}
+    if args.encrypted:
+        settings.setdefault("MATRIX_E2EE", True)
+    if args.appservice:
+        appservice = {"hs_token": "bench", "port": free_port()}
+        settings.setdefault("MATRIX_APPSERVICE", appservice)
+        server.push_to("http://127.0.0.1:{}".format(appservice["port"]), "bench")
+    config = make_config(port, data_dir, **settings)
+
+    started = time.monotonic()
+    bot = start_bot(config)
+    if args.appservice:
+        if not wait_for(lambda: getattr(bot._sync, "listening", False), args.timeout):
+            raise SystemExit("bot never started listening for transactions")
+        startup = time.monotonic() - started
+    else:
+        if not wait_for(lambda: server.first_incremental_sync, args.timeout):
+            raise SystemExit("bot never finished its initial sync")
+        startup = server.first_incremental_sync - started
+
+    # with MATRIX_DISPATCH_PROCESSES, the workers can still be starting up
+    processes = settings.get("MATRIX_DISPATCH_PROCESSES", 0)
+    if processes and not wait_for(
+        lambda: bot._async.processes.ready >= processes, args.timeout
+    ):
+        raise SystemExit("dispatch workers never started")
+
+    # fire the commands, spread over the rooms, and wait for all the replies to come back
+    injected = dict()
+    sent_before = len(server.sent)
+    wrappers_before = wrappers_made(bot)
+    began = time.monotonic()
+    for i in range(args.messages):
+        room = server.rooms[i % len(server.rooms)]
+        sender = server.members[i % len(server.members)]
+        for j in range(args.chatter):
+            server.inject(room, sender, "just chatting {} {}".format(i, j))
+        injected["bench-{}".format(i)] = time.monotonic()
+        server.inject(room, sender, "!echo bench-{}".format(i))
+        if args.rate:
+            time.sleep(1 / args.rate)
+
+    latencies = []
+    checked = [sent_before]
+
+    async def bodies(sent: list) -> list:
+        # the bot is still running, so decrypt on its loop rather than alongside it
+        return [
+            plaintext(bot, room, kind, content).get("body", "")
+            for _, room, kind, content in sent
+        ]
+
+    def answered() -> bool:
+        sent = server.sent[checked[0] :]
+        checked[0] += len(sent)
+        found = asyncio.run_coroutine_threadsafe(bodies(sent), bot.loop).result()
+        for (when, *_), body in zip(sent, found):
+            for token in TOKEN.findall(body):
+                sent_at = injected.pop(token, None)
+                if sent_at is not None:
+                    latencies.append(when - sent_at)
+        return not injected
+
+    wait_for(answered, args.timeout)
+    elapsed = time.monotonic() - began
+    wrappers = wrappers_made(bot) - wrappers_before
+
+    results = {
+        "rooms": args.rooms,
+        "members": args.members,
+        "latency": args.latency,
+        "encrypted": args.encrypted,
+        "appservice": args.appservice,
+        "messages": args.messages,
+        "chatter": args.chatter,
+        "replies": len(latencies),
+        "startup_seconds": round(startup, 4),
+        "msgs_per_second": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "wrappers_per_message": round(wrappers / max(1, args.messages), 3),
+        "requests": dict(server.requests),
+    }
+    metrics = getattr(bot, "metrics", None)
+    if metrics:
+        snapshot = metrics()
+        sync_bytes = snapshot.get(("matrix_sync_bytes", ()), {})
+        sync_parse = snapshot.get(("matrix_sync_parse_seconds", ()), {})
+        results["sync_kb"] = round(sync_bytes.get("sum", 0) / 1024, 1)
+        results["sync_parse_ms"] = round(sync_parse.get("sum", 0) * 1000, 2)
+        results["backend"] = {
+            "{}{}".format(name, dict(labels) if labels else ""): value
+            for (name, labels), value in snapshot.items()
+            if not isinstance(value, dict)
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rooms", type=int, default=50, help="rooms the bot is in")
+    parser.add_argument("--members", type=int, default=10, help="members per room")
+    parser.add_argument("--messages", type=int, default=500, help="commands to send")
+    parser.add_argument(
+        "--chatter", type=int, default=0, help="non-command messages per command"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every request"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="commands per second (default: all at once)",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=120, help="give up after this many seconds"
+    )
+    parser.add_argument(
+        "--encrypted", action="store_true", help="encrypted rooms, with MATRIX_E2EE"
+    )
+    parser.add_argument(
+        "--appservice", action="store_true", help="push events to the bot instead"
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=JSON",
+        help="extra config, eg --set MATRIX_STATE_STORE=true",
+    )
+    parser.add_argument("--output", help="also write the results here as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    # errbot and nio don't really do shutting down from another thread
+    sys.stdout.flush()
+    os._exit(0 if results["replies"] == args.messages else 1)
+
+
+if __name__ == "__main__":
+    main()
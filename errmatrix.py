@@ -6,22 +6,47 @@
 # This is based on the other backends that are out there for errbot.
 ##
 
+import io
 import os
+import re
 import sys
+import html
+import json
+import time
+import queue
+import runpy
+import pickle
+import random
+import sqlite3
 import logging
 import asyncio
+import fnmatch
+import hashlib
+import functools
+import itertools
+import contextvars
+import weakref
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from uuid import uuid4
 
 # image management
 import mimetypes
 from PIL import Image
-import aiofiles.os
 
 from dataclasses import dataclass
+from types import SimpleNamespace
 from typing import Any, Optional, List, Dict
 
 import errbot.backends.base as backend
 from errbot.core import ErrBot
+from errbot.botplugin import BotPlugin
 from errbot.rendering import xhtml
+from errbot.storage.base import StorageBase, StoragePluginBase
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
 
 log = logging.getLogger(__name__)
 
@@ -35,6 +60,12 @@ except ImportError:
     )
     sys.exit(1)
 
+try:
+    import blurhash
+except ImportError:
+    # optional, images just won't have a placeholder while they load
+    blurhash = None
+
 
 @dataclass
 class MatrixProfile:
@@ -49,6 +80,2294 @@ class MatrixProfile:
             return self.extras["address"]
 
 
+class MetricsRegistry(object):
+    """Counters and histograms for the backend, in the style of prometheus.
+
+    Metrics are created the first time they're used, labels are passed as keyword arguments. Collectors
+    are functions returning `{(name, labels): value}` gauges, called when the metrics are read, so
+    things that already keep their own stats (caches, queues) don't need to report them as they go.
+    Observations can come from any thread.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._histograms = dict()
+        self._buckets = dict()
+        self._collectors = []
+
+    def set_buckets(self, name: str, buckets) -> None:
+        """Use different histogram buckets for a metric (the default ones are for timings)."""
+        self._buckets[name] = tuple(buckets)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if not hist:
+                bounds = self._buckets.get(name, self.BUCKETS)
+                hist = self._histograms[key] = {
+                    "bounds": bounds,
+                    "buckets": [0] * len(bounds),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            for i, bound in enumerate(hist["bounds"]):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def add_collector(self, collector) -> None:
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def remove_collector(self, collector) -> None:
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def _gauges(self) -> dict:
+        gauges = dict()
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                gauges.update(collector())
+            except Exception:
+                log.exception("error collecting metrics from %s", collector)
+        return gauges
+
+    def snapshot(self) -> dict:
+        """All the metrics as a dict, keyed by (name, labels)."""
+        with self._lock:
+            snapshot = dict(self._counters)
+            for key, hist in self._histograms.items():
+                snapshot[key] = {
+                    "buckets": dict(zip(hist["bounds"], hist["buckets"])),
+                    "sum": hist["sum"],
+                    "count": hist["count"],
+                }
+        snapshot.update(self._gauges())
+        return snapshot
+
+    @staticmethod
+    def _escape(value) -> str:
+        """Escape a label value the way the text format wants: backslashes, quotes and newlines."""
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    @classmethod
+    def _labels(cls, labels, extra=()) -> str:
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{{{}}}".format(
+            ",".join('{}="{}"'.format(k, cls._escape(v)) for k, v in labels)
+        )
+
+    def render(self) -> str:
+        """All the metrics in the prometheus text format."""
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} {}".format(name, kind))
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, dict(hist, buckets=list(hist["buckets"])))
+                for key, hist in self._histograms.items()
+            )
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append("{}{} {}".format(name, self._labels(labels), value))
+
+        for (name, labels), hist in histograms:
+            declare(name, "histogram")
+            for bound, count in zip(hist["bounds"], hist["buckets"]):
+                le = self._labels(labels, [("le", bound)])
+                lines.append("{}_bucket{} {}".format(name, le, count))
+            le = self._labels(labels, [("le", "+Inf")])
+            lines.append("{}_bucket{} {}".format(name, le, hist["count"]))
+            tail = self._labels(labels)
+            lines.append("{}_sum{} {}".format(name, tail, hist["sum"]))
+            lines.append("{}_count{} {}".format(name, tail, hist["count"]))
+
+        for (name, labels), value in sorted(self._gauges().items()):
+            declare(name, "gauge")
+            lines.append("{}{} {}".format(name, self._labels(labels), value))
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+METRICS.set_buckets(
+    "matrix_sync_batch_events", (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+)
+METRICS.set_buckets("matrix_sync_bytes", (1e3, 1e4, 1e5, 1e6, 1e7, 1e8))
+
+
+def count_error(response: nio.responses.ErrorResponse) -> None:
+    """Count an error response from the homeserver."""
+    METRICS.inc(
+        "matrix_error_responses_total",
+        response=type(response).__name__,
+        code=response.status_code or "",
+    )
+
+
+# the trace an event is being handled as part of, if it's being traced (see Tracer)
+TRACE_CONTEXT = contextvars.ContextVar("matrix_trace", default=None)
+
+
+class Tracer(object):
+    """Records where the time goes between an event arriving and the bot's replies being sent.
+
+    A trace is started for a sample of the events we hand to errbot. Its context is a plain tuple of
+    (trace id, root span id, when errbot started handling the event). It's carried on the message
+    (`msg._trace`, which build_reply copies to the reply) and in TRACE_CONTEXT, so sends from the dispatch
+    threads and the event loop can find it too. Finished spans are exported every `interval` seconds, as
+    json lines appended to `path` and/or as OTLP/HTTP json to an OpenTelemetry collector at `endpoint`.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.1,
+        path: str = None,
+        endpoint: str = None,
+        service: str = "errbot",
+        interval: float = 5.0,
+        max_pending: int = 10000,
+    ):
+        self._sample_rate = sample_rate
+        self._path = path
+        self._endpoint = endpoint
+        self._service = service
+        self._interval = interval
+        self._pending = deque(maxlen=max_pending)
+        self._session = None
+        self._closed = False
+
+        self.traces = 0
+        self.spans = 0
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def start(self) -> Optional[tuple]:
+        """Start a trace, or None if this one isn't in the sample."""
+        if random.random() >= self._sample_rate:
+            return None
+        self.traces += 1
+        return (os.urandom(16).hex(), os.urandom(8).hex(), None)
+
+    def record(
+        self,
+        name: str,
+        trace: tuple,
+        start: float,
+        end: float,
+        root=False,
+        **attributes,
+    ) -> None:
+        """Record a span of `trace`, from `start` to `end` (both from time.time()).
+
+        The root span is recorded last, once we know when handling the event finished.
+        """
+        if root:
+            span_id, parent = trace[1], None
+        else:
+            span_id, parent = os.urandom(8).hex(), trace[1]
+
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append((trace[0], span_id, parent, name, start, end, attributes))
+        self.spans += 1
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            if self._closed:
+                return
+            await self.flush()
+
+    async def close(self) -> None:
+        """Export whatever hasn't been yet, and stop exporting."""
+        self._closed = True
+        await self.flush()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def flush(self) -> None:
+        """Export the spans recorded since we last did."""
+        spans = []
+        while self._pending:
+            spans.append(self._pending.popleft())
+        if not spans:
+            return
+
+        try:
+            if self._path:
+                await asyncio.get_event_loop().run_in_executor(None, self._write, spans)
+            if self._endpoint:
+                await self._post(spans)
+            self.exported += len(spans)
+        except Exception as e:
+            log.warning("couldn't export %d spans: %s", len(spans), e)
+            self.errors += 1
+
+    def _write(self, spans: list) -> None:
+        with open(self._path, "a") as f:
+            for trace_id, span_id, parent, name, start, end, attributes in spans:
+                span = {
+                    "trace_id": trace_id,
+                    "span_id": span_id,
+                    "parent_id": parent,
+                    "name": name,
+                    "start": start,
+                    "duration_ms": round((end - start) * 1000, 3),
+                    "attributes": attributes,
+                }
+                f.write(json.dumps(span) + "\n")
+
+    async def _post(self, spans: list) -> None:
+        if self._session is None:
+            self._session = ClientSession(timeout=ClientTimeout(total=10))
+        async with self._session.post(self._endpoint, json=self._otlp(spans)) as resp:
+            if resp.status >= 300:
+                raise ValueError("collector said {}".format(resp.status))
+
+    @staticmethod
+    def _attributes(attributes: dict) -> list:
+        values = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                value = {"boolValue": value}
+            elif isinstance(value, int):
+                value = {"intValue": str(value)}
+            elif isinstance(value, float):
+                value = {"doubleValue": value}
+            else:
+                value = {"stringValue": str(value)}
+            values.append({"key": key, "value": value})
+        return values
+
+    def _otlp(self, spans: list) -> dict:
+        """The spans as an OTLP ExportTraceServiceRequest, in its json encoding."""
+        otlp_spans = []
+        for trace_id, span_id, parent, name, start, end, attributes in spans:
+            span = {
+                "traceId": trace_id,
+                "spanId": span_id,
+                "name": name,
+                "kind": (
+                    2 if parent is None else 1
+                ),  # server for the root, internal for the rest
+                "startTimeUnixNano": str(int(start * 1e9)),
+                "endTimeUnixNano": str(int(end * 1e9)),
+                "attributes": self._attributes(attributes),
+            }
+            if parent:
+                span["parentSpanId"] = parent
+            otlp_spans.append(span)
+
+        resource = self._attributes({"service.name": self._service})
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": resource},
+                    "scopeSpans": [
+                        {"scope": {"name": "errmatrix"}, "spans": otlp_spans}
+                    ],
+                }
+            ]
+        }
+
+    def stats(self) -> dict:
+        return {
+            "traces": self.traces,
+            "spans": self.spans,
+            "pending": len(self._pending),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+
+class LookupCache(object):
+    """A bounded TTL/LRU cache in front of an async lookup (profiles, aliases, events, etc...).
+
+    Every private message and reaction needs the sender's profile, and asking the homeserver each time is
+    an extra round-trip before any command runs. Entries expire after `ttl` seconds, the least recently
+    used entry is dropped once we hold `maxsize` of them (or, if `sizeof` is given, once they add up to
+    more than `maxbytes`), and concurrent lookups for the same key share a single request. Lookups that
+    return None aren't cached.
+    """
+
+    def __init__(
+        self,
+        fetch,
+        maxsize: int = 1024,
+        ttl: float = 300,
+        maxbytes: Optional[int] = None,
+        sizeof=None,
+    ):
+        self._fetch = fetch
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._maxbytes = maxbytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._pending = dict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key, fetch=None):
+        """Get the value for key, fetching it if it's not cached (or has expired).
+
+        `fetch` overrides the lookup function for this call, for when the key alone isn't
+        enough."""
+        entry = self._entries.get(key)
+        if entry:
+            expires, value, size = entry
+            if expires > time.monotonic():
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            self._remove(key)
+
+        self.misses += 1
+        future = self._pending.get(key)
+        if future:
+            self.coalesced += 1
+        else:
+            future = asyncio.ensure_future((fetch or self._fetch)(key))
+            future.add_done_callback(functools.partial(self._store, key))
+            self._pending[key] = future
+
+        # shielded so a cancelled caller doesn't cancel the lookup for everyone else
+        return await asyncio.shield(future)
+
+    def _store(self, key, future: asyncio.Future) -> None:
+        # if we got invalidated while the request was in flight, the result is already stale
+        if self._pending.get(key) is not future:
+            return
+        del self._pending[key]
+
+        if future.cancelled() or future.exception() or future.result() is None:
+            return
+        self.put(key, future.result())
+
+    def put(self, key, value) -> None:
+        """Add something we found out about without asking for it."""
+        self._remove(key)
+
+        size = self._sizeof(value) if self._sizeof else 0
+        self._entries[key] = (time.monotonic() + self._ttl, value, size)
+        self._bytes += size
+
+        while len(self._entries) > self._maxsize or (
+            self._maxbytes and self._bytes > self._maxbytes
+        ):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry[2]
+
+    def invalidate(self, key) -> None:
+        """Forget anything we know about key."""
+        self._remove(key)
+        self._pending.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# only load the members we actually need, rather than every member of every room
+LAZY_LOAD_FILTER = {
+    "room": {
+        "state": {"lazy_load_members": True},
+        "timeline": {"lazy_load_members": True},
+    }
+}
+
+# state nio keeps track of for each room, we always need these to keep the rooms up to date
+STATE_EVENT_TYPES = (
+    "m.room.create",
+    "m.room.member",
+    "m.room.name",
+    "m.room.topic",
+    "m.room.avatar",
+    "m.room.canonical_alias",
+    "m.room.join_rules",
+    "m.room.guest_access",
+    "m.room.history_visibility",
+    "m.room.power_levels",
+    "m.room.encryption",
+    "m.room.tombstone",
+    "m.space.parent",
+    "m.space.child",
+)
+
+# the events nio's event classes are parsed from, for working out what callbacks want
+NIO_EVENT_TYPES = (
+    (nio.events.room_events.RoomMessage, "m.room.message"),
+    (nio.events.room_events.MegolmEvent, "m.room.encrypted"),
+    (nio.events.room_events.RoomMemberEvent, "m.room.member"),
+    (nio.events.room_events.ReactionEvent, "m.reaction"),
+    (nio.events.room_events.StickerEvent, "m.sticker"),
+    (nio.events.room_events.RedactionEvent, "m.room.redaction"),
+    (nio.events.room_events.RoomTopicEvent, "m.room.topic"),
+    (nio.events.room_events.RoomNameEvent, "m.room.name"),
+    (nio.events.room_events.PowerLevelsEvent, "m.room.power_levels"),
+)
+
+# event types matrix_events_total is broken down by. Anyone can send an event of any type, so the rest are
+# counted as "other" rather than each getting a series of its own
+COUNTED_EVENT_TYPES = frozenset(STATE_EVENT_TYPES).union(t for _, t in NIO_EVENT_TYPES)
+
+
+class MatrixClient(nio.AsyncClient):
+    """nio's client, keeping track of how much sync responses cost us to download and parse."""
+
+    # when the response whose events we're handling arrived (from time.time()), for tracing
+    received_at = None
+
+    async def create_matrix_response(
+        self, response_class, transport_response, *args, **kwargs
+    ):
+        if not issubclass(response_class, nio.responses.SyncResponse):
+            return await super().create_matrix_response(
+                response_class, transport_response, *args, **kwargs
+            )
+
+        # download it first, so the parse time is just the parsing
+        self.received_at = time.time()
+        body = await transport_response.read()
+        started = time.monotonic()
+        response = await super().create_matrix_response(
+            response_class, transport_response, *args, **kwargs
+        )
+        METRICS.observe("matrix_sync_parse_seconds", time.monotonic() - started)
+        METRICS.observe("matrix_sync_bytes", len(body))
+        return response
+
+
+class MatrixStateStore(object):
+    """An on-disk copy of the sync token and room state.
+
+    Without this, every restart needs a full_state sync, which for a bot in a lot of rooms takes minutes.
+    We keep the raw state events for each joined room (as they appear in sync responses) and rebuild nio's
+    rooms from them on startup, so we can carry on from the last `next_batch` instead.
+    """
+
+    def __init__(self, path: str):
+        # created with the backend, but only ever used from the event loop thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS state (room_id TEXT, type TEXT, state_key TEXT, "
+            "event TEXT, PRIMARY KEY (room_id, type, state_key))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS summary (room_id TEXT PRIMARY KEY, "
+            "invited INTEGER, joined INTEGER, heroes TEXT)"
+        )
+
+    def load_token(self) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT value FROM meta WHERE key = 'next_batch'"
+        ).fetchone()
+        return row[0] if row else None
+
+    def restore(self, client: nio.AsyncClient) -> int:
+        """Rebuild the client's joined rooms from the store, returns the number of rooms restored."""
+        for room_id, event in self._db.execute(
+            "SELECT room_id, event FROM state ORDER BY rowid"
+        ):
+            if room_id not in client.rooms:
+                client.rooms[room_id] = nio.MatrixRoom(room_id, client.user_id)
+            room = client.rooms[room_id]
+
+            event = nio.Event.parse_event(json.loads(event))
+            if isinstance(event, nio.RoomMemberEvent):
+                room.handle_membership(event)
+            elif isinstance(event, nio.Event):
+                room.handle_event(event)
+
+        for room_id, invited, joined, heroes in self._db.execute(
+            "SELECT room_id, invited, joined, heroes FROM summary"
+        ):
+            if room_id in client.rooms:
+                client.rooms[room_id].update_summary(
+                    nio.RoomSummary(invited, joined, json.loads(heroes or "null"))
+                )
+
+        return len(client.rooms)
+
+    def canonical_aliases(self) -> Dict[str, dict]:
+        """The content of each room's `m.room.canonical_alias` event (nio's rooms only keep the main alias)."""
+        return {
+            room_id: json.loads(event).get("content") or {}
+            for room_id, event in self._db.execute(
+                "SELECT room_id, event FROM state WHERE type = 'm.room.canonical_alias'"
+            )
+        }
+
+    def save(self, response: nio.SyncResponse) -> None:
+        """Record the state changes and token from a sync response."""
+        with self._db:
+            for room_id, info in response.rooms.join.items():
+                events = [e.source for e in info.state + info.timeline.events]
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)",
+                    [
+                        (room_id, e["type"], e["state_key"], json.dumps(e))
+                        for e in events
+                        if "type" in e and "state_key" in e
+                    ],
+                )
+
+                summary = info.summary
+                if summary:
+                    heroes = json.dumps(summary.heroes) if summary.heroes else None
+                    self._db.execute(
+                        "INSERT INTO summary VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (room_id) DO UPDATE SET "
+                        "invited = coalesce(excluded.invited, invited), "
+                        "joined = coalesce(excluded.joined, joined), "
+                        "heroes = coalesce(excluded.heroes, heroes)",
+                        (
+                            room_id,
+                            summary.invited_member_count,
+                            summary.joined_member_count,
+                            heroes,
+                        ),
+                    )
+
+            for room_id in response.rooms.leave:
+                self._db.execute("DELETE FROM state WHERE room_id = ?", (room_id,))
+                self._db.execute("DELETE FROM summary WHERE room_id = ?", (room_id,))
+
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('next_batch', ?)",
+                (response.next_batch,),
+            )
+
+    def clear(self) -> None:
+        with self._db:
+            self._db.execute("DELETE FROM meta")
+            self._db.execute("DELETE FROM state")
+            self._db.execute("DELETE FROM summary")
+
+
+def backoff_delay(failures: int, min_backoff: float, max_backoff: float) -> float:
+    """How long to wait after `failures` failures in a row: exponential, with jitter."""
+    backoff = min(max_backoff, min_backoff * 2**failures)
+    return random.uniform(min_backoff, backoff)
+
+
+class SyncLoop(object):
+    """Keeps us syncing with the homeserver.
+
+    This does what nio's sync_forever does (sync, send to-device messages, sort out keys and run the
+    response callbacks), but if a sync fails we back off exponentially, with jitter, rather than trying
+    again straight away. It also remembers when we last synced, so health checks can tell if we're stuck.
+    """
+
+    def __init__(
+        self,
+        client: nio.AsyncClient,
+        timeout: int = 30000,
+        sync_filter: "SyncFilter" = None,
+        min_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        crypto: "CryptoSessions" = None,
+    ):
+        self._client = client
+        self._crypto = crypto
+        self._timeout = timeout
+        self._filter = sync_filter
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+
+        self.last_sync = time.monotonic()
+        self.failures = 0
+        self.syncs = 0
+
+    async def run(self) -> None:
+        while True:
+            try:
+                synced = await self._sync_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("error syncing: %s", e)
+                synced = False
+
+            if synced:
+                self.failures = 0
+                self.syncs += 1
+                self.last_sync = time.monotonic()
+                continue
+
+            self.failures += 1
+            METRICS.inc("matrix_sync_failures_total")
+            delay = backoff_delay(self.failures, self._min_backoff, self._max_backoff)
+            log.info("sync failed (%d in a row), retry in %.1fs", self.failures, delay)
+            await asyncio.sleep(delay)
+
+    async def _sync_once(self) -> bool:
+        client = self._client
+        sync_filter = await self._filter.get() if self._filter else None
+        tasks = [
+            asyncio.ensure_future(client.sync(self._timeout, sync_filter)),
+            asyncio.ensure_future(client.send_to_device_messages()),
+        ]
+        if self._crypto:
+            tasks.extend(self._crypto.maintenance())
+
+        try:
+            for response in asyncio.as_completed(tasks):
+                response = await response
+                if response is not None:
+                    await client.run_response_callbacks([response])
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        response = tasks[0].result()
+        if isinstance(response, nio.responses.SyncError):
+            log.warning("sync failed: %s", response)
+            return False
+        return True
+
+    def lag(self) -> float:
+        """Seconds since we last synced."""
+        return time.monotonic() - self.last_sync
+
+    def stats(self) -> dict:
+        return {"lag": self.lag(), "failures": self.failures, "syncs": self.syncs}
+
+
+class AppServiceListener(object):
+    """Takes events pushed to us by the homeserver, for running the bot as an application service.
+
+    Instead of the bot long-polling /sync, the homeserver PUTs transactions of events to us as they
+    happen. Each transaction is turned into a sync response and fed through nio, so room state is kept up
+    to date and the usual callbacks (messages, reactions, invites) handle the events. The homeserver sends
+    a transaction again until we acknowledge it, so we remember the ids of recent ones and acknowledge
+    repeats without handling them twice. Nothing is acknowledged until it has been handled.
+    """
+
+    def __init__(
+        self,
+        client: nio.AsyncClient,
+        hs_token: str,
+        host: str = "127.0.0.1",
+        port: int = 8009,
+        remember: int = 1024,
+    ):
+        self._client = client
+        self._hs_token = hs_token
+        self._host = host
+        self._port = port
+        self._remember = remember
+        self._transactions = OrderedDict()
+        self._created = time.monotonic()
+        self.listening = False
+
+        self.transactions = 0
+        self.duplicates = 0
+        self.events = 0
+
+    async def run(self) -> None:
+        app = web.Application()
+        for prefix in ("/_matrix/app/v1", ""):
+            app.router.add_put(prefix + "/transactions/{txn_id}", self.on_transaction)
+            app.router.add_post(prefix + "/ping", self.on_ping)
+            app.router.add_get(prefix + "/users/{user_id}", self.not_found)
+            app.router.add_get(prefix + "/rooms/{alias}", self.not_found)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, self._host, self._port).start()
+        log.info("listening for transactions on http://%s:%s", self._host, self._port)
+
+        self.listening = True
+        try:
+            await asyncio.get_event_loop().create_future()
+        finally:
+            self.listening = False
+            await runner.cleanup()
+
+    def _authorized(self, request) -> bool:
+        token = request.query.get("access_token")
+        header = request.headers.get("Authorization", "")
+        if header.startswith("Bearer "):
+            token = header[len("Bearer ") :]
+        return token == self._hs_token
+
+    @staticmethod
+    def _forbidden():
+        return web.json_response(
+            {"errcode": "M_FORBIDDEN", "error": "bad hs_token"}, status=403
+        )
+
+    async def on_transaction(self, request):
+        if not self._authorized(request):
+            return self._forbidden()
+
+        txn_id = request.match_info["txn_id"]
+        handled = self._transactions.get(txn_id)
+        if handled is not None:
+            self.duplicates += 1
+            METRICS.inc("matrix_appservice_transactions_total", result="duplicate")
+        else:
+            events = (await request.json()).get("events", [])
+            handled = asyncio.ensure_future(self._handle(events))
+            self._transactions[txn_id] = handled
+            while len(self._transactions) > self._remember:
+                self._transactions.popitem(last=False)
+
+        try:
+            await asyncio.shield(handled)
+        except Exception:
+            # forget it, so it's handled again when the homeserver retries
+            log.exception("error handling transaction %s", txn_id)
+            METRICS.inc("matrix_appservice_transactions_total", result="error")
+            self._transactions.pop(txn_id, None)
+            return web.json_response(
+                {"errcode": "M_UNKNOWN", "error": "try again"}, status=500
+            )
+        return web.json_response({})
+
+    async def on_ping(self, request):
+        if not self._authorized(request):
+            return self._forbidden()
+        return web.json_response({})
+
+    async def not_found(self, request):
+        if not self._authorized(request):
+            return self._forbidden()
+        return web.json_response(
+            {"errcode": "M_NOT_FOUND", "error": "not found"}, status=404
+        )
+
+    async def _handle(self, events: list) -> None:
+        self._client.received_at = time.time()
+        response = await self._as_sync(events)
+
+        # nio ignores a sync with the same token as the last, but we want to stay on the real one
+        token = self._client.next_batch
+        await self._client.receive_response(response)
+        self._client.next_batch = response.next_batch = token
+        await self._client.run_response_callbacks([response])
+
+        self.transactions += 1
+        self.events += len(events)
+        METRICS.inc("matrix_appservice_transactions_total", result="handled")
+
+    async def _as_sync(self, events: list) -> nio.responses.SyncResponse:
+        """Sort a transaction's events into the rooms of a sync response."""
+        rooms = {"join": {}, "invite": {}, "leave": {}}
+        for event in events:
+            room_id = event.get("room_id")
+            if not room_id:
+                continue
+
+            if (
+                event.get("type") == "m.room.member"
+                and event.get("state_key") == self._client.user_id
+            ):
+                membership = event.get("content", {}).get("membership")
+                if membership == "invite":
+                    state = event.get("unsigned", {}).get("invite_room_state", [])
+                    rooms["invite"][room_id] = {
+                        "invite_state": {"events": state + [event]}
+                    }
+                    continue
+                if membership in ("leave", "ban"):
+                    rooms["join"].pop(room_id, None)
+                    rooms["leave"][room_id] = {
+                        "timeline": {"events": [event]},
+                        "state": {"events": []},
+                    }
+                    continue
+
+            if room_id not in rooms["join"]:
+                rooms["join"][room_id] = {
+                    "timeline": {"events": [], "limited": False},
+                    "state": {"events": await self._new_room_state(room_id)},
+                }
+            rooms["join"][room_id]["timeline"]["events"].append(event)
+
+        # like a lazy loading sync, include the members of anyone talking that we don't know yet
+        senders = {
+            (room_id, event["sender"])
+            for room_id, room in rooms["join"].items()
+            for event in room["timeline"]["events"]
+            if room_id in self._client.rooms
+            and event["sender"] not in self._client.rooms[room_id].users
+        }
+        members = await asyncio.gather(
+            *(self._member(room_id, sender) for room_id, sender in senders)
+        )
+        for (room_id, _), member in zip(senders, members):
+            if member:
+                rooms["join"][room_id]["state"]["events"].append(member)
+
+        return nio.responses.SyncResponse.from_dict(
+            {
+                "next_batch": str(uuid4()),
+                "rooms": rooms,
+                "presence": {"events": []},
+                "account_data": {"events": []},
+                "to_device": {"events": []},
+            }
+        )
+
+    async def _member(self, room_id: str, user_id: str) -> Optional[dict]:
+        response = await self._client.room_get_state_event(
+            room_id, "m.room.member", user_id
+        )
+        if not isinstance(response, nio.responses.RoomGetStateEventResponse):
+            return None
+        return {
+            "type": "m.room.member",
+            "state_key": user_id,
+            "sender": user_id,
+            "event_id": "$member-{}-{}".format(room_id, user_id),
+            "origin_server_ts": 0,
+            "content": response.content,
+        }
+
+    async def _new_room_state(self, room_id: str) -> list:
+        """The state of a room we've only just joined, transactions only tell us what changes."""
+        if room_id in self._client.rooms:
+            return []
+
+        response = await self._client.room_get_state(room_id)
+        if isinstance(response, nio.responses.RoomGetStateResponse):
+            return response.events
+        count_error(response)
+        log.warning("couldn't get the state of %s: %s", room_id, response)
+        return []
+
+    def lag(self) -> float:
+        """The homeserver pushes to us, so we're never behind once we're listening."""
+        return 0.0 if self.listening else time.monotonic() - self._created
+
+    def stats(self) -> dict:
+        return {
+            "lag": self.lag(),
+            "transactions": self.transactions,
+            "duplicates": self.duplicates,
+            "events": self.events,
+        }
+
+
+class SyncFilter(object):
+    """The filter we sync with, so the homeserver only sends us the events we use.
+
+    The timeline is limited to what the event callbacks want (ours, and any a plugin has added to the nio
+    client), the state nio needs to keep rooms up to date, `event_types` and the `matrix_event_types` of
+    active plugins. Presence, typing, receipts and room account data are left out completely. If a
+    callback wants events we can't put a type to, the timeline and state aren't filtered by type.
+
+    The filter is uploaded once and the id reused, until something changes what's in it.
+    """
+
+    def __init__(
+        self,
+        client: nio.AsyncClient,
+        bot=None,
+        enabled: bool = True,
+        lazy_load_members: bool = True,
+        event_types=(),
+        callbacks: dict = None,
+    ):
+        self._client = client
+        self._bot = bot
+        self._enabled = enabled
+        self._lazy_load_members = lazy_load_members
+        self._event_types = set(event_types)
+        self._callbacks = callbacks or {}
+        self._plugin_types = None
+        self._ids = dict()
+
+        self.uploads = 0
+
+    def plugins_changed(self) -> None:
+        self._plugin_types = None
+
+    def _extra_types(self) -> set:
+        if self._plugin_types is None:
+            self._plugin_types = set()
+            if self._bot is not None:
+                for plugin in self._bot.plugin_manager.get_all_active_plugins():
+                    self._plugin_types.update(getattr(plugin, "matrix_event_types", ()))
+        return self._event_types | self._plugin_types
+
+    @staticmethod
+    def _types_for(event_filter) -> Optional[set]:
+        """The event types a nio callback filter matches, None if we can't tell."""
+        if event_filter is None:
+            return None
+
+        types = set()
+        classes = event_filter if isinstance(event_filter, tuple) else (event_filter,)
+        for cls in classes:
+            if issubclass(cls, nio.events.invite_events.InviteEvent):
+                continue  # invites can't be filtered
+            matched = [
+                kind for parent, kind in NIO_EVENT_TYPES if issubclass(cls, parent)
+            ]
+            if not matched:
+                return None
+            types.update(matched)
+        return types
+
+    def timeline_types(self) -> Optional[set]:
+        """Every event type something wants to see, None if that's everything."""
+        types = set(STATE_EVENT_TYPES) | self._extra_types()
+        for callback_types in self._callbacks.values():
+            types.update(callback_types)
+
+        for callback in self._client.event_callbacks:
+            if callback.func in self._callbacks:
+                continue
+            callback_types = self._types_for(callback.filter)
+            if callback_types is None:
+                return None
+            types.update(callback_types)
+        return types
+
+    def build(self) -> dict:
+        """The filter definition, as it's uploaded to the homeserver."""
+        extra = self._extra_types()
+        room = {
+            "state": {},
+            "timeline": {},
+            "ephemeral": {"not_types": ["*"]},
+            "account_data": {"not_types": ["*"]},
+        }
+
+        types = self.timeline_types()
+        if types is not None:
+            room["state"]["types"] = sorted(set(STATE_EVENT_TYPES) | extra)
+            room["timeline"]["types"] = sorted(types)
+
+        if self._lazy_load_members:
+            room["state"]["lazy_load_members"] = True
+            room["timeline"]["lazy_load_members"] = True
+
+        return {
+            "presence": {"not_types": ["*"]},
+            "account_data": {"types": sorted({"m.direct"} | extra)},
+            "room": room,
+        }
+
+    async def get(self):
+        """What to pass as the sync filter, the id of the uploaded filter if we can."""
+        if not self._enabled:
+            return LAZY_LOAD_FILTER if self._lazy_load_members else None
+
+        definition = self.build()
+        key = json.dumps(definition, sort_keys=True)
+        if key not in self._ids:
+            response = await self._client.upload_filter(**definition)
+            if isinstance(response, nio.responses.UploadFilterResponse):
+                self.uploads += 1
+                self._ids[key] = response.filter_id
+                log.info("uploaded sync filter %s", response.filter_id)
+            else:
+                # send it with every sync instead, it does the same thing
+                count_error(response)
+                log.warning("couldn't upload sync filter: %s", response)
+                self._ids[key] = definition
+        return self._ids[key]
+
+    def stats(self) -> dict:
+        types = self.timeline_types() if self._enabled else None
+        return {"uploads": self.uploads, "types": len(types) if types else 0}
+
+
+class CryptoSessions(object):
+    """Keeps the keys we need for encrypted rooms, asking the homeserver as little as possible.
+
+    Key uploads and queries are only ever in flight once, whoever asks for them (the sync loop, or a
+    send to a room with new members). Key claims made at the same time are merged into one request, so
+    a broadcast to many encrypted rooms claims keys for all of them at once. Megolm sessions are only
+    shared when we're about to send to a room, never up front for every room we're in.
+    """
+
+    def __init__(self, client: nio.AsyncClient, ignore_unverified: bool = True):
+        self._client = client
+        self.ignore_unverified = ignore_unverified
+        self._uploading = None
+        self._querying = None
+        self._claims = None
+        self._claiming = None
+
+        self.shared = 0
+        self.claimed = 0
+        self.undecryptable = 0
+
+    @staticmethod
+    def _check(response) -> None:
+        if isinstance(response, nio.responses.ErrorResponse):
+            count_error(response)
+            log.warning("crypto request failed: %s", response)
+
+    def maintenance(self) -> list:
+        """Anything the sync loop should do alongside its next sync, as futures of nio responses."""
+        client = self._client
+        tasks = []
+        if client.should_upload_keys:
+            if self._uploading is None or self._uploading.done():
+                self._uploading = asyncio.ensure_future(client.keys_upload())
+            tasks.append(self._uploading)
+        if client.should_query_keys:
+            tasks.append(asyncio.ensure_future(self.query_keys()))
+        if client.should_claim_keys:
+            users = client.get_users_for_key_claiming()
+            tasks.append(asyncio.ensure_future(self.claim_keys(users)))
+        return tasks
+
+    async def query_keys(self):
+        """Fetch device keys for anyone new, sharing a query that's already in flight."""
+        if self._querying is None or self._querying.done():
+            if not self._client.should_query_keys:
+                return None
+            self._querying = asyncio.ensure_future(self._client.keys_query())
+        return await asyncio.shield(self._querying)
+
+    async def claim_keys(self, users: Dict[str, List[str]]):
+        """Claim one-time keys for these devices, along with anyone else who asks on this tick."""
+        if not users:
+            return None
+        if self._claims is None:
+            self._claims = dict()
+            self._claiming = asyncio.ensure_future(self._claim())
+        for user, devices in users.items():
+            self._claims.setdefault(user, set()).update(devices)
+        return await asyncio.shield(self._claiming)
+
+    async def _claim(self):
+        await asyncio.sleep(0)
+        users, self._claims = self._claims, None
+        self.claimed += sum(len(devices) for devices in users.values())
+        METRICS.inc("matrix_crypto_key_claims_total")
+        return await self._client.keys_claim(
+            {user: list(devices) for user, devices in users.items()}
+        )
+
+    async def prepare(self, room_id: str) -> None:
+        """Get a room ready for us to send an encrypted event to it.
+
+        Does nothing for rooms that aren't encrypted, or that already have a Megolm session shared.
+        """
+        client = self._client
+        room = client.rooms.get(room_id)
+        if client.olm is None or room is None or not room.encrypted:
+            return
+
+        started = time.monotonic()
+        if not room.members_synced:
+            self._check(await client.joined_members(room_id))
+        await self.query_keys()
+
+        if not client.olm.should_share_group_session(room_id):
+            return
+        if room_id in client.sharing_session:
+            await client.sharing_session[room_id].wait()
+            return
+
+        self._check(await self.claim_keys(client.get_missing_sessions(room_id)))
+        response = await client.share_group_session(
+            room_id, ignore_unverified_devices=self.ignore_unverified
+        )
+        self._check(response)
+        self.shared += 1
+        METRICS.observe("matrix_crypto_share_seconds", time.monotonic() - started)
+
+    async def undecrypted(self, event: nio.events.room_events.MegolmEvent) -> None:
+        """Ask our other devices (and the sender) for the key to an event we couldn't read."""
+        self.undecryptable += 1
+        METRICS.inc("matrix_crypto_undecryptable_total")
+        if event.session_id in self._client.outgoing_key_requests:
+            return
+        self._check(await self._client.request_room_key(event))
+
+    def stats(self) -> dict:
+        return {
+            "shared": self.shared,
+            "claimed": self.claimed,
+            "undecryptable": self.undecryptable,
+        }
+
+
+class CommandFilter(object):
+    """Decides if errbot could care about a message, before we do any work on it.
+
+    Most messages in a busy room are just people talking. errbot only acts on the ones that start with
+    BOT_PREFIX or one of BOT_ALT_PREFIXES (or mention the bot), and `route` says "command" for those.
+    An unprefixed `re_botcmd` needs errbot to look at everything, so then everything is a "command" too.
+    Otherwise, if a plugin has a `callback_message`, the rest are "listeners": they only need handing to
+    those plugins, not looking for commands in. The core ChatRoom plugin only counts as a listener when
+    CHATROOM_RELAY or REVERSE_CHATROOM_RELAY is set, as that's all its callback_message does.
+    Anything else gets None and can be dropped.
+    """
+
+    COMMAND = "command"
+    LISTENERS = "listeners"
+
+    def __init__(self, bot):
+        self._bot = bot
+        self._plugins = None
+        self.passed = 0
+        self.listened = 0
+        self.skipped = 0
+
+    def plugins_changed(self) -> None:
+        self._plugins = None
+
+    def _listeners(self) -> tuple:
+        """The active plugins that want messages that aren't commands, and whether errbot has to see them."""
+        if self._plugins is None:
+            config = self._bot.bot_config
+            relays = getattr(config, "CHATROOM_RELAY", None) or getattr(
+                config, "REVERSE_CHATROOM_RELAY", None
+            )
+            listeners = tuple(
+                plugin
+                for plugin in self._bot.plugin_manager.get_all_active_plugins()
+                if type(plugin).callback_message is not BotPlugin.callback_message
+                and (plugin.name != "ChatRoom" or relays)
+            )
+            unprefixed = any(
+                not command._err_command_prefix_required
+                for command in self._bot.re_commands.values()
+            )
+            self._plugins = (listeners, unprefixed)
+        return self._plugins
+
+    def listeners(self) -> tuple:
+        return self._listeners()[0]
+
+    def _is_command(self, room, body: str) -> bool:
+        config = self._bot.bot_config
+        if body.startswith(config.BOT_PREFIX):
+            return True
+        if config.BOT_ALT_PREFIXES:
+            tomatch = body.lower() if config.BOT_ALT_PREFIX_CASEINSENSITIVE else body
+            if tomatch.startswith(self._bot.bot_alt_prefixes):
+                return True
+        return config.BOT_PREFIX_OPTIONAL_ON_CHAT and (
+            room.is_group and room.member_count == 2
+        )
+
+    def _mentions_bot(self, event) -> bool:
+        user_id = self._bot._client.user_id
+        content = event.source.get("content", {})
+        mentions = content.get("m.mentions", {}).get("user_ids", ())
+        formatted = getattr(event, "formatted_body", None) or ""
+        return user_id in mentions or user_id in event.body or user_id in formatted
+
+    def route(self, room, event) -> Optional[str]:
+        listeners, unprefixed = self._listeners()
+        if (
+            self._is_command(room, event.body)
+            or self._mentions_bot(event)
+            or unprefixed
+        ):
+            self.passed += 1
+            METRICS.inc("matrix_command_filter_total", result="passed")
+            return self.COMMAND
+
+        if listeners:
+            self.listened += 1
+            METRICS.inc("matrix_command_filter_total", result="listeners")
+            return self.LISTENERS
+
+        self.skipped += 1
+        METRICS.inc("matrix_command_filter_total", result="skipped")
+        return None
+
+    def stats(self) -> dict:
+        seen = self.passed + self.listened + self.skipped
+        return {
+            "passed": self.passed,
+            "listened": self.listened,
+            "skipped": self.skipped,
+            "skip_ratio": self.skipped / seen if seen else 0.0,
+        }
+
+
+class CallbackDispatcher(object):
+    """Hands inbound events to errbot on a dedicated, bounded pool of threads.
+
+    Events for the same room are handled in the order they arrived, events for different rooms can run
+    in parallel. At most `queue_size` events can be waiting or running at once, after that `overflow`
+    decides what happens to new ones:
+
+    * "block" - wait for space, which stops us processing the sync (and so pushes back on the homeserver)
+    * "defer" - park the event (up to another `queue_size` of them) and hand it over once there is space
+    * "drop" - log it and move on
+
+    The backend turns errbot's BOT_ASYNC off, so handling a command here includes running it.
+    """
+
+    OVERFLOW_POLICIES = ("block", "defer", "drop")
+
+    def __init__(self, workers: int = 8, queue_size: int = 256, overflow="block"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(
+                "unknown overflow policy {}, expected one of {}".format(
+                    overflow, self.OVERFLOW_POLICIES
+                )
+            )
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="matrix-dispatch"
+        )
+        self._queue_size = queue_size
+        self._overflow = overflow
+
+        self._lanes = dict()
+        self._queued = 0
+        self._deferred = deque()
+        self._space = asyncio.Event()
+
+        # these get updated from the worker threads
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def submit(self, key: str, func, *args) -> bool:
+        """Queue func(*args) to run after anything else queued with the same key.
+
+        Returns False if the event was dropped."""
+        job = (time.monotonic(), func, args)
+        if self._queued < self._queue_size and not self._deferred:
+            self._enqueue(key, job)
+            return True
+
+        if self._overflow == "block":
+            while self._queued >= self._queue_size:
+                self._space.clear()
+                await self._space.wait()
+            self._enqueue(key, job)
+            return True
+
+        if self._overflow == "defer" and len(self._deferred) < self._queue_size:
+            self._deferred.append((key, job))
+            return True
+
+        with self._lock:
+            self.dropped += 1
+        log.warning("dispatch queue is full, dropping event for %s", key)
+        return False
+
+    def _enqueue(self, key: str, job) -> None:
+        self._queued += 1
+        if key in self._lanes:
+            self._lanes[key].append(job)
+        else:
+            self._lanes[key] = deque([job])
+            asyncio.ensure_future(self._drain(key))
+
+    async def _drain(self, key: str) -> None:
+        loop = asyncio.get_event_loop()
+        lane = self._lanes[key]
+        while lane:
+            await loop.run_in_executor(self._executor, self._run, *lane[0])
+            lane.popleft()
+            self._queued -= 1
+
+            while self._deferred and self._queued < self._queue_size:
+                self._enqueue(*self._deferred.popleft())
+            self._space.set()
+        del self._lanes[key]
+
+    def _run(self, enqueued: float, func, args) -> None:
+        waited = time.monotonic() - enqueued
+        METRICS.observe("matrix_dispatch_wait_seconds", waited)
+        with self._lock:
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+        try:
+            func(*args)
+        except Exception:
+            log.exception("error handling event in %s", func)
+        finally:
+            with self._lock:
+                self.processed += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queued": self._queued,
+                "deferred": len(self._deferred),
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "wait_avg": self.wait_total / self.processed if self.processed else 0.0,
+                "wait_max": self.wait_max,
+            }
+
+
+class WorkerStorage(StorageBase):
+    """One of the main process's stores, as seen from a dispatch worker (see ProcessDispatcher._storage)."""
+
+    def __init__(self, request):
+        self._request = request
+
+    def get(self, key: str) -> Any:
+        return self._request("get", key)
+
+    def set(self, key: str, value: Any) -> None:
+        self._request("set", key, value)
+
+    def remove(self, key: str) -> None:
+        self._request("remove", key)
+
+    def len(self) -> int:
+        return self._request("len")
+
+    def keys(self) -> list:
+        return self._request("keys")
+
+    def close(self) -> None:
+        pass
+
+
+class WorkerStoragePlugin(StoragePluginBase):
+    """Opens WorkerStorage, `request(namespace, method, *args)` asks the main process to do things to it."""
+
+    def __init__(self, bot_config, request):
+        super().__init__(bot_config)
+        self._request = request
+
+    def open(self, namespace: str) -> StorageBase:
+        return WorkerStorage(functools.partial(self._request, namespace))
+
+
+class ProcessDispatcher(object):
+    """Runs errbot's message handling in a pool of worker processes.
+
+    CPU-heavy plugins hold the GIL, which slows down syncing and sending for everyone else. With this, each
+    worker is its own errbot with the same plugins, but no connection to matrix: we hand it messages in a
+    compact form (see encode_message) and it hands back anything it wants to send, for us to send.
+
+    The CallbackDispatcher still decides what runs when, so messages for a room are handled in order. Plugins
+    are activated in the workers as well as here, but there they only handle messages: pollers, webhooks and
+    callback_connect only run here. Storage is only kept here too, workers read and write ours through us.
+
+    A worker that spends more than `timeout` seconds on one message is killed and replaced, so a stuck
+    plugin doesn't hold up its room forever.
+    """
+
+    # what the workers are allowed to ask us to do
+    FORWARDED = ("send_message", "react", "send_image", "send_file", "broadcast")
+    STORAGE = ("get", "set", "remove", "len", "keys")
+
+    def __init__(self, bot, processes: int = 2, timeout: Optional[float] = 300.0):
+        self._bot = bot
+        self._processes = processes
+        self._timeout = timeout
+        self._context = multiprocessing.get_context("spawn")
+        self._jobs = self._context.Queue()
+        self._results = self._context.Queue()
+        self._replies = [self._context.Queue() for _ in range(processes)]
+        self._workers = []
+        self._stopping = False
+
+        # what the workers ask us to send can block (resolving an alias, say), so it's done off the thread
+        # reading results. One thread per worker keeps what each worker sends in order
+        self._callers = [
+            ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="matrix-worker-calls-{}".format(i)
+            )
+            for i in range(processes)
+        ]
+
+        # job id -> future, and which job each worker is running (and since when)
+        self._ids = itertools.count()
+        self._pending = dict()
+        self._running = dict()
+        self._lock = threading.Lock()
+        self.ready = 0
+        self.processed = 0
+        self.restarts = 0
+
+    def _settings(self) -> dict:
+        """The bot's config, as something we can hand to a worker."""
+        config = self._bot.bot_config
+        settings = dict()
+        for name in dir(config):
+            if not name.isupper():
+                continue
+            value = getattr(config, name)
+            try:
+                pickle.dumps(value)
+            except Exception:
+                log.debug("not passing %s to the dispatch workers", name)
+                continue
+            settings[name] = value
+
+        # the workers don't talk to matrix, and shouldn't fight us over the data dir. A job is only done once
+        # the command has run, so they run commands straight away rather than on errbot's pool
+        settings.update(
+            BOT_ASYNC=False,
+            STORAGE="Memory",
+            AUTOINSTALL_DEPS=False,
+            MATRIX_STATE_STORE=False,
+            MATRIX_METRICS_PORT=None,
+            MATRIX_APPSERVICE=None,
+            MATRIX_E2EE=False,
+            MATRIX_DISPATCH_PROCESSES=0,
+        )
+        return settings
+
+    def _snapshot(self) -> dict:
+        """What the workers need to know about us that isn't in the config (or our storage)."""
+        return {
+            "user_id": self._bot.bot_identifier._id,
+            "repos": self._bot.repo_manager.get_all_repos_paths(),
+        }
+
+    def start(self) -> None:
+        snapshot = self._snapshot()
+        for index in range(self._processes):
+            self._workers.append(self._spawn(index, snapshot))
+        threading.Thread(
+            target=self._read_results, name="matrix-process-results", daemon=True
+        ).start()
+
+    def _spawn(self, index: int, snapshot: dict):
+        # the backend is loaded from a file rather than imported, so the worker runs it the same way
+        worker = self._context.Process(
+            target=runpy.run_path,
+            args=(__file__,),
+            kwargs=dict(
+                run_name="__matrix_worker__",
+                init_globals={
+                    "WORKER_ARGS": (
+                        self._settings(),
+                        snapshot,
+                        index,
+                        self._jobs,
+                        self._results,
+                        self._replies[index],
+                    )
+                },
+            ),
+            name="matrix-worker-{}".format(index),
+            daemon=True,
+        )
+        worker.start()
+        return worker
+
+    def callback_message(self, msg) -> None:
+        """Hand a message to whichever worker is free, and wait for it to be dealt with.
+
+        If the worker dies or times out, or we're stopped, before it's done this raises rather than waiting
+        forever.
+        """
+        job = next(self._ids)
+        done = Future()
+        with self._lock:
+            if self._stopping:
+                raise RuntimeError("the dispatch workers have stopped")
+            self._pending[job] = done
+        self._jobs.put((job, encode_message(msg)))
+        done.result()
+
+    def _read_results(self) -> None:
+        checked = time.monotonic()
+        while not self._stopping:
+            # however busy the workers are, notice if one of them has died
+            if time.monotonic() - checked >= 1:
+                self._check_workers()
+                checked = time.monotonic()
+            try:
+                index, kind, payload = self._results.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            if kind == "start":
+                self._running[index] = (payload, time.monotonic())
+            elif kind == "done":
+                self._running.pop(index, None)
+                self._finish(payload)
+            elif kind == "call":
+                self._callers[index].submit(self._call, *payload)
+            elif kind == "storage":
+                self._storage(index, *payload)
+            elif kind == "ready":
+                log.info("dispatch worker %d is ready", index)
+                self.ready += 1
+
+    def _finish(self, job: int, error: Exception = None) -> None:
+        with self._lock:
+            done = self._pending.pop(job, None)
+            self.processed += 1
+        if done is None:
+            return
+        if error:
+            done.set_exception(error)
+        else:
+            done.set_result(None)
+
+    def _call(self, method: str, args: tuple, kwargs: dict) -> None:
+        if method not in self.FORWARDED:
+            log.warning("dispatch worker tried to call %s, ignoring it", method)
+            return
+
+        def room_for(room_id, details):
+            return self._bot._async.get_room(room_id)
+
+        try:
+            args = [decode_value(arg, room_for) for arg in args]
+            kwargs = {
+                key: decode_value(value, room_for) for key, value in kwargs.items()
+            }
+            getattr(self._bot, method)(*args, **kwargs)
+        except Exception:
+            log.exception("error doing %s for a dispatch worker", method)
+            METRICS.inc("matrix_exceptions_total", handler="process_" + method)
+
+    def _storage(
+        self, index: int, call: int, namespace: str, method: str, args: tuple
+    ) -> None:
+        """Do something to one of our stores for a worker, and send it the answer (see WorkerStorage)."""
+        try:
+            if method not in self.STORAGE:
+                raise ValueError("{} isn't a storage method".format(method))
+            bot = self._bot
+            owner = {
+                "core": bot.plugin_manager,
+                "repomgr": bot.repo_manager,
+                bot.namespace: bot,
+            }.get(namespace) or bot.plugin_manager.get_plugin_obj_by_name(namespace)
+            if owner is None or not owner.is_open_storage():
+                raise KeyError("{} has no storage open".format(namespace))
+
+            value = getattr(owner._store, method)(*args)
+            reply = (call, None, list(value) if method == "keys" else value)
+        except KeyError as e:
+            reply = (call, e, None)
+        except Exception as e:
+            log.exception(
+                "error doing %s on %s for a dispatch worker", method, namespace
+            )
+            reply = (call, RuntimeError(str(e)), None)
+        self._replies[index].put(reply)
+
+    def _check_workers(self) -> None:
+        """Replace any worker that has died or is stuck, failing whatever it was working on."""
+        now = time.monotonic()
+        for index, worker in enumerate(self._workers):
+            if self._stopping:
+                return
+            running = self._running.get(index)
+            if worker.is_alive():
+                if not (self._timeout and running and now - running[1] > self._timeout):
+                    continue
+                log.error(
+                    "dispatch worker %d has been on one message for more than %ss, restarting it",
+                    index,
+                    self._timeout,
+                )
+                worker.kill()
+                worker.join(timeout=5)
+                error = RuntimeError("dispatch worker timed out")
+            else:
+                log.error(
+                    "dispatch worker %d died (exit code %s)", index, worker.exitcode
+                )
+                error = RuntimeError("dispatch worker died")
+
+            self._running.pop(index, None)
+            if running is not None:
+                self._finish(running[0], error)
+            self._workers[index] = self._spawn(index, self._snapshot())
+            self.ready -= 1
+            self.restarts += 1
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopping = True
+            pending, self._pending = self._pending, dict()
+        for done in pending.values():
+            done.set_exception(RuntimeError("the dispatch workers have stopped"))
+
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        for caller in self._callers:
+            caller.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "processes": sum(worker.is_alive() for worker in self._workers),
+                "ready": self.ready,
+                "pending": len(self._pending),
+                "processed": self.processed,
+                "restarts": self.restarts,
+            }
+
+
+class SendScheduler(object):
+    """Sends events to matrix in order, without upsetting the homeserver's rate limiter.
+
+    Each room gets its own lane, so events for a room go out in the order they were queued. All lanes
+    share a token bucket (`rate` events a second, bursts of up to `burst`) and at most `max_in_flight`
+    requests are made at once. If the homeserver tells us to slow down (M_LIMIT_EXCEEDED) everything
+    waits for `retry_after_ms` and the event is sent again with the same transaction id.
+
+    With `crypto`, encrypted rooms get their Megolm session shared before the first event goes out. With
+    `tracer`, events queued as part of a trace record how long they waited and how long sending took.
+    """
+
+    def __init__(
+        self,
+        client: nio.AsyncClient,
+        rate: float = 5.0,
+        burst: int = 10,
+        max_in_flight: int = 4,
+        max_retries: int = 5,
+        crypto: CryptoSessions = None,
+        tracer: Tracer = None,
+    ):
+        self._client = client
+        self._crypto = crypto
+        self._tracer = tracer
+        self._rate = rate
+        self._burst = burst
+        self._max_retries = max_retries
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+        self._lanes = dict()
+
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def send(self, room_id: str, message_type: str, content: dict) -> asyncio.Future:
+        """Queue an event for a room.
+
+        The returned future resolves to the nio response once the event has been sent
+        (or we gave up)."""
+        future = asyncio.get_event_loop().create_future()
+        traced = (TRACE_CONTEXT.get(), time.time())
+        job = (message_type, content, str(uuid4()), future, traced)
+
+        if room_id in self._lanes:
+            self._lanes[room_id].append(job)
+        else:
+            self._lanes[room_id] = deque([job])
+            asyncio.ensure_future(self._drain(room_id))
+        return future
+
+    def rate_limited(self, retry_after_ms: Optional[int]) -> None:
+        """Stop sending anything until the homeserver is happy with us again."""
+        resume = time.monotonic() + (retry_after_ms or 5000) / 1000
+        self._paused_until = max(self._paused_until, resume)
+        self._tokens = 0.0
+
+    async def _drain(self, room_id: str) -> None:
+        lane = self._lanes[room_id]
+        while lane:
+            message_type, content, tx_id, future, traced = lane[0]
+            try:
+                result = await self._deliver(
+                    room_id, message_type, content, tx_id, traced
+                )
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                log.warning("error sending %s to %s: %s", message_type, room_id, e)
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            lane.popleft()
+        del self._lanes[room_id]
+
+    async def _deliver(self, room_id, message_type, content, tx_id, traced=(None, 0)):
+        ignore_unverified = self._crypto is not None and self._crypto.ignore_unverified
+        trace, queued = traced if self._tracer else (None, 0)
+        for attempt in range(self._max_retries + 1):
+            if self._crypto:
+                await self._crypto.prepare(room_id)
+            await self._acquire()
+            async with self._in_flight:
+                sending = time.time()
+                if trace:
+                    self._tracer.record("matrix.send_queue", trace, queued, sending)
+
+                started = time.monotonic()
+                result = await self._client.room_send(
+                    room_id,
+                    message_type=message_type,
+                    content=content,
+                    tx_id=tx_id,
+                    ignore_unverified_devices=ignore_unverified,
+                )
+                METRICS.observe("matrix_room_send_seconds", time.monotonic() - started)
+
+            if trace:
+                # a retry's wait for the rate limiter counts as queueing again
+                queued = time.time()
+                self._tracer.record(
+                    "matrix.room_send",
+                    trace,
+                    sending,
+                    queued,
+                    room_id=room_id,
+                    event_type=message_type,
+                    attempt=attempt,
+                    ok=not isinstance(result, nio.responses.RoomSendError),
+                )
+
+            if not isinstance(result, nio.responses.RoomSendError):
+                self.sent += 1
+                return result
+
+            count_error(result)
+
+            if result.status_code != "M_LIMIT_EXCEEDED":
+                break
+
+            log.info("rate limited sending to %s, retrying", room_id)
+            self.rate_limited(result.retry_after_ms)
+            self.retried += 1
+
+        self.failed += 1
+        return result
+
+    async def _acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            refill = (now - self._updated) * self._rate
+            self._tokens = min(self._burst, self._tokens + refill)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    def stats(self) -> dict:
+        return {
+            "queued": sum(len(lane) for lane in self._lanes.values()),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+class JoinQueue(object):
+    """Joins the rooms we're invited to, in the background.
+
+    Invites are checked against the allow/deny lists first (mxid or room id globs, matched against the
+    inviter and the room, deny wins), so unwanted invites never cost a request. Each room is only joined
+    once however many invites for it turn up, at most `max_in_flight` joins happen at a time, and if the
+    homeserver rate limits us the join is retried after backing off.
+    """
+
+    def __init__(
+        self,
+        client: nio.AsyncClient,
+        allow: Optional[List[str]] = None,
+        deny: Optional[List[str]] = None,
+        max_in_flight: int = 2,
+        max_retries: int = 5,
+    ):
+        self._client = client
+        self._allow = allow
+        self._deny = deny or ()
+        self._max_retries = max_retries
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._paused_until = 0.0
+        self._joining = dict()
+
+        self.joined = 0
+        self.denied = 0
+        self.duplicate = 0
+        self.retried = 0
+        self.failed = 0
+
+    @staticmethod
+    def _matches(patterns, *names) -> bool:
+        return any(fnmatch.fnmatchcase(n, p) for p in patterns for n in names)
+
+    def allowed(self, room_id: str, inviter: str) -> bool:
+        if self._matches(self._deny, room_id, inviter):
+            return False
+        return self._allow is None or self._matches(self._allow, room_id, inviter)
+
+    def invited(self, room_id: str, inviter: str) -> bool:
+        """Queue a join for a room we've been invited to, returns False if we won't be joining it."""
+        if room_id in self._joining or room_id in self._client.rooms:
+            self.duplicate += 1
+            return False
+
+        if not self.allowed(room_id, inviter):
+            log.info("ignoring invite to %s from %s", room_id, inviter)
+            self.denied += 1
+            METRICS.inc("matrix_invites_total", result="denied")
+            return False
+
+        future = asyncio.ensure_future(self._join(room_id))
+        self._joining[room_id] = future
+        future.add_done_callback(lambda f: self._joining.pop(room_id, None))
+        return True
+
+    def rate_limited(self, retry_after_ms: Optional[int]) -> None:
+        resume = time.monotonic() + (retry_after_ms or 5000) / 1000
+        self._paused_until = max(self._paused_until, resume)
+
+    async def _join(self, room_id: str):
+        for attempt in range(self._max_retries + 1):
+            async with self._in_flight:
+                while time.monotonic() < self._paused_until:
+                    await asyncio.sleep(self._paused_until - time.monotonic())
+                result = await self._client.join(room_id)
+
+            if isinstance(result, nio.responses.JoinResponse):
+                self.joined += 1
+                METRICS.inc("matrix_invites_total", result="joined")
+                return result
+
+            count_error(result)
+            if result.status_code != "M_LIMIT_EXCEEDED":
+                break
+
+            log.info("rate limited joining %s, retrying", room_id)
+            self.retried += 1
+            self.rate_limited(result.retry_after_ms or 1000 * 2**attempt)
+
+        log.warning("couldn't join %s: %s", room_id, result)
+        self.failed += 1
+        METRICS.inc("matrix_invites_total", result="failed")
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "joining": len(self._joining),
+            "joined": self.joined,
+            "denied": self.denied,
+            "duplicate": self.duplicate,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+class MessageCoalescer(object):
+    """Merges bursts of plain messages to the same room into a single event.
+
+    Plugins that stream their output call send_message a lot for what is really one reply. Plain
+    m.text/m.notice messages to a room that arrive within `window` seconds of the first one are sent as one
+    event (up to `max_size` characters). Anything else for that room sends what we have first, so the
+    order is kept. Has the same `send` interface as SendScheduler, which does the actual sending.
+    """
+
+    COALESCABLE_KEYS = {"msgtype", "body", "format", "formatted_body"}
+
+    def __init__(self, sender: SendScheduler, window: float = 0.5, max_size=16000):
+        self._sender = sender
+        self._window = window
+        self._max_size = max_size
+        self._pending = dict()
+
+        self.merged = 0
+
+    def _coalescable(self, message_type: str, content: dict) -> bool:
+        return (
+            message_type == "m.room.message"
+            and content.get("msgtype") in ("m.text", "m.notice")
+            and content.keys() <= self.COALESCABLE_KEYS
+            and content.get("format", "org.matrix.custom.html")
+            == "org.matrix.custom.html"
+        )
+
+    @staticmethod
+    def _size(content: dict) -> int:
+        return len(content["body"]) + len(content.get("formatted_body", ""))
+
+    def send(self, room_id: str, message_type: str, content: dict) -> asyncio.Future:
+        if not self._coalescable(message_type, content):
+            self.flush(room_id)
+            return self._sender.send(room_id, message_type, content)
+
+        pending = self._pending.get(room_id)
+        if pending and (
+            pending["msgtype"] != content["msgtype"]
+            or pending["size"] + self._size(content) > self._max_size
+        ):
+            self.flush(room_id)
+            pending = None
+
+        if not pending:
+            pending = {
+                "msgtype": content["msgtype"],
+                "size": 0,
+                "parts": [],
+                "futures": [],
+                "timer": asyncio.get_event_loop().call_later(
+                    self._window, self.flush, room_id
+                ),
+            }
+            self._pending[room_id] = pending
+
+        future = asyncio.get_event_loop().create_future()
+        pending["size"] += self._size(content)
+        pending["parts"].append(content)
+        pending["futures"].append(future)
+        return future
+
+    def flush(self, room_id: str) -> None:
+        """Send anything we are holding on to for a room."""
+        pending = self._pending.pop(room_id, None)
+        if not pending:
+            return
+        pending["timer"].cancel()
+
+        parts = pending["parts"]
+        if len(parts) == 1:
+            content = parts[0]
+        else:
+            self.merged += len(parts) - 1
+            content = {
+                "msgtype": pending["msgtype"],
+                "body": "\n".join(part["body"] for part in parts),
+            }
+            if any("formatted_body" in part for part in parts):
+                content["format"] = "org.matrix.custom.html"
+                content["formatted_body"] = "\n".join(
+                    part.get("formatted_body")
+                    or html.escape(part["body"]).replace("\n", "<br/>")
+                    for part in parts
+                )
+
+        sent = self._sender.send(room_id, "m.room.message", content)
+        sent.add_done_callback(functools.partial(self._resolve, pending["futures"]))
+
+    @staticmethod
+    def _resolve(futures, sent: asyncio.Future) -> None:
+        for future in futures:
+            if future.done():
+                continue
+            if sent.cancelled():
+                future.cancel()
+            elif sent.exception():
+                future.set_exception(sent.exception())
+            else:
+                future.set_result(sent.result())
+
+    def stats(self) -> dict:
+        stats = self._sender.stats()
+        stats["merged"] = self.merged
+        return stats
+
+
+class DirectRoomIndex(object):
+    """Keeps track of which room to use for talking privately to each user.
+
+    The index is built once from the rooms we know about and our `m.direct` account data, then kept up to
+    date from membership events, so finding a user's private room doesn't need a scan of every room. If
+    there isn't one, only one room gets created even if several messages are waiting on it.
+    """
+
+    def __init__(self, client: nio.AsyncClient):
+        self._client = client
+        self._rooms = dict()
+        self._creating = dict()
+
+    @staticmethod
+    def _is_private(room) -> bool:
+        return room.is_group and room.member_count == 2
+
+    def rebuild(self, direct: Optional[Dict[str, List[str]]] = None) -> None:
+        """Start again from the rooms we're in, and the contents of `m.direct` if we have it."""
+        self._rooms.clear()
+        for room in self._client.rooms.values():
+            self.on_room_changed(room)
+        if direct:
+            self.update_direct(direct)
+
+    def _is_valid(self, user: str, room_id: Optional[str]) -> bool:
+        """Is this still a private room we share with `user`?"""
+        room = self._client.rooms.get(room_id) if room_id else None
+        return room is not None and self._is_private(room) and user in room.users
+
+    def update_direct(self, direct: Dict[str, List[str]]) -> None:
+        """Use the rooms from `m.direct` account data, if they're still private rooms with that user."""
+        for user, room_ids in direct.items():
+            if self._is_valid(user, self._rooms.get(user)):
+                continue
+            for room_id in room_ids:
+                if self._is_valid(user, room_id):
+                    self._rooms[user] = room_id
+                    break
+
+    def on_room_changed(self, room) -> None:
+        """Update the index after the membership of a room changes."""
+        if self._is_private(room) and room.room_id in self._client.rooms:
+            # with lazy loading the other member might only be in the summary's heroes
+            heroes = room.summary.heroes if room.summary else None
+            for user in set(room.users).union(heroes or ()):
+                if user != self._client.user_id:
+                    self._rooms.setdefault(user, room.room_id)
+            return
+
+        # it's not private any more (or we've left), so don't use it
+        self.forget_room(room.room_id)
+
+    def forget_room(self, room_id: str) -> None:
+        for user in [u for (u, r) in self._rooms.items() if r == room_id]:
+            del self._rooms[user]
+
+    def lookup(self, user: str) -> Optional[str]:
+        return self._rooms.get(user)
+
+    async def get_or_create(self, user: str) -> str:
+        room_id = self._rooms.get(user)
+        if room_id:
+            return room_id
+
+        future = self._creating.get(user)
+        if not future:
+            future = asyncio.ensure_future(self._create(user))
+            self._creating[user] = future
+            future.add_done_callback(lambda f: self._creating.pop(user, None))
+        return await asyncio.shield(future)
+
+    async def _create(self, user: str) -> str:
+        log.debug("no suitable room for %s, making new one!", user)
+        new_room = await self._client.room_create(is_direct=True, invite=[user])
+
+        if isinstance(new_room, nio.responses.RoomCreateResponse):
+            self._rooms[user] = new_room.room_id
+            return new_room.room_id
+        else:
+            log.warning("could not create management room: %s", new_room)
+            raise Exception("couldn't create management room")
+
+    def stats(self) -> dict:
+        return {"size": len(self._rooms), "creating": len(self._creating)}
+
+
+class AliasIndex(object):
+    """Maps room aliases (canonical and alt) to room ids for the rooms we're in.
+
+    Kept up to date from `m.room.canonical_alias` state events as they come in, so looking up an alias
+    doesn't depend on how many rooms we are in.
+    """
+
+    def __init__(self, client: nio.AsyncClient):
+        self._client = client
+        self._aliases = dict()
+        self._by_room = dict()
+
+    def rebuild(self, contents: Optional[Dict[str, dict]] = None) -> None:
+        """Start again from the canonical aliases nio knows about.
+
+        nio only keeps a room's canonical alias, so `contents` (the `m.room.canonical_alias` content for each
+        room, from the state store) is used where we have it, to get the alt aliases back as well.
+        """
+        self._aliases.clear()
+        self._by_room.clear()
+        for room in self._client.rooms.values():
+            if contents and room.room_id in contents:
+                self.update(room.room_id, contents[room.room_id])
+            elif room.canonical_alias:
+                self._set(room.room_id, {room.canonical_alias})
+
+    def update(self, room_id: str, content: dict) -> None:
+        """Update a room from the content of its `m.room.canonical_alias` event."""
+        aliases = set(content.get("alt_aliases") or [])
+        if content.get("alias"):
+            aliases.add(content["alias"])
+        self._set(room_id, aliases)
+
+    def _set(self, room_id: str, aliases: set) -> None:
+        for alias in self._by_room.pop(room_id, ()):
+            if self._aliases.get(alias) == room_id:
+                del self._aliases[alias]
+
+        if aliases:
+            self._by_room[room_id] = aliases
+            for alias in aliases:
+                self._aliases[alias] = room_id
+
+    def forget_room(self, room_id: str) -> None:
+        self._set(room_id, set())
+
+    def lookup(self, alias: str) -> Optional[str]:
+        return self._aliases.get(alias)
+
+    def stats(self) -> dict:
+        return {"size": len(self._aliases)}
+
+
+class UploadCache(object):
+    """Remembers the mxc url for everything we've uploaded, keyed by sha256 of the content.
+
+    With a path, this is kept on disk so it survives restarts (mxc urls don't expire).
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS uploads (digest TEXT PRIMARY KEY, url TEXT)"
+        )
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest: str) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT url FROM uploads WHERE digest = ?", (digest,)
+        ).fetchone()
+        if row:
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, digest: str, url: str) -> None:
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?)", (digest, url)
+            )
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class IdentityMap(object):
+    """Hands out the same MatrixRoom and MatrixRoomOccupant wrappers each time they're asked for.
+
+    Rooms are keyed by room id and occupants by (room id, user id), so the wrappers for a busy room are made
+    once rather than for every message. A wrapper is made again if nio has replaced the room or member it
+    wraps, and leaving a room or a change of membership drops them straight away.
+
+    Occupants are only held weakly, so iterating over a big room's members doesn't keep a wrapper for all of
+    them. The ones looked up by id (message senders, mostly) are also kept in a small LRU so they're reused.
+    """
+
+    def __init__(self, client: nio.AsyncClient, backend=None, maxsize: int = 1024):
+        self._client = client
+        self._backend = backend
+        self._rooms = dict()
+        self._occupants = dict()
+        self._senders = OrderedDict()
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def room(self, room_id: str) -> "MatrixRoom":
+        room = self._rooms.get(room_id)
+        native = self._client.rooms.get(room_id)
+        if room is not None and room._room is native:
+            self.hits += 1
+            return room
+
+        self.misses += 1
+        self.forget_room(room_id)
+        room = MatrixRoom(room_id, self._client, self._backend)
+        if native is not None:
+            room._identities = self
+            self._rooms[room_id] = room
+        return room
+
+    def occupant(
+        self, room: "MatrixRoom", native_user, keep: bool = False
+    ) -> "MatrixRoomOccupant":
+        occupants = self._occupants.get(room._id)
+        if occupants is None:
+            occupants = self._occupants[room._id] = weakref.WeakValueDictionary()
+        occupant = occupants.get(native_user.user_id)
+        if occupant is None or occupant._native is not native_user:
+            self.misses += 1
+            occupant = MatrixRoomOccupant(native_user, room)
+            occupants[native_user.user_id] = occupant
+        else:
+            self.hits += 1
+
+        if keep:
+            key = (room._id, native_user.user_id)
+            self._senders[key] = occupant
+            self._senders.move_to_end(key)
+            while len(self._senders) > self._maxsize:
+                self._senders.popitem(last=False)
+        return occupant
+
+    def forget_room(self, room_id: str) -> None:
+        self._rooms.pop(room_id, None)
+        self._occupants.pop(room_id, None)
+        for key in [key for key in self._senders if key[0] == room_id]:
+            del self._senders[key]
+
+    def forget_member(self, room_id: str, user_id: str) -> None:
+        self._occupants.get(room_id, {}).pop(user_id, None)
+        self._senders.pop((room_id, user_id), None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._rooms),
+            "occupants": sum(len(o) for o in list(self._occupants.values())),
+            "senders": len(self._senders),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
 class MatrixIdentifier(backend.Identifier):
     def __init__(self, mxid: str):
         self._id = mxid
@@ -117,9 +2436,11 @@ class MatrixRoom(MatrixIdentifier, backend.Room):
     that the async and sync code mixes.
     """
 
-    def __init__(self, mxid: str, client: nio.Client):
+    def __init__(self, mxid: str, client: nio.Client, backend=None):
         super().__init__(mxid)
         self._client = client
+        self._backend = backend
+        self._identities = None
 
         if mxid in self._client.rooms:
             self._room = self._client.rooms[mxid]
@@ -183,8 +2504,9 @@ class MatrixRoom(MatrixIdentifier, backend.Room):
         if not self._id or not self._client:
             return False
 
-        log.debug("is a room: %s", self._room.is_group)
-        log.debug("has a member count of : %s", self._room.member_count)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("is a room: %s", self._room.is_group)
+            log.debug("has a member count of : %s", self._room.member_count)
         return self._room.is_group and self._room.member_count == 2
 
     @property
@@ -219,25 +2541,36 @@ class MatrixRoom(MatrixIdentifier, backend.Room):
         raise NotImplementedError("not supported yet")
 
     def get_occupant(self, mxid):
-        """Get a matrix room occupant from an mxid"""
+        """Get a matrix room occupant from an mxid.
+
+        We lazy load room members, so if we haven't seen this user yet we ask the homeserver about them
+        (unless we're on the event loop, where we can't wait for the answer)."""
         if not self.joined:
             raise backend.RoomNotJoinedError()
-        try:
-            native_user = self._room.users[mxid]
-            return MatrixRoomOccupant(native_user, self)
-        except KeyError:
+
+        native_user = self._room.users.get(mxid)
+        if native_user is None and self._backend is not None:
+            if self._backend.load_member(self._id, mxid):
+                native_user = self._room.users.get(mxid)
+
+        if native_user is None:
             return None
+        return self._occupant(native_user, keep=True)
+
+    def _occupant(self, native_user, keep: bool = False) -> "MatrixRoomOccupant":
+        if self._identities is None:
+            return MatrixRoomOccupant(native_user, self)
+        return self._identities.occupant(self, native_user, keep)
 
     @property
-    def occupants(self) -> List[backend.RoomOccupant]:
-        """Get RoomOccupant proxies for all room members."""
+    def occupants(self) -> Sequence[backend.RoomOccupant]:
+        """Get RoomOccupant proxies for all room members.
+
+        This is a view, the member list is only fetched (and the proxies made) when it's used.
+        """
         if not self.joined:
             raise backend.RoomNotJoinedError()
-
-        people = list()
-        for user in self._room.users.values():
-            people.append(MatrixRoomOccupant(user, self))
-        return people
+        return MatrixRoomOccupants(self)
 
     def invite(self, *args: List[Any]) -> None:
         """Invite one or more users to a room.
@@ -283,6 +2616,44 @@ class MatrixRoom(MatrixIdentifier, backend.Room):
         return "{} ({})".format(self.display_name, self.machine_name)
 
 
+class MatrixRoomOccupants(Sequence):
+    """The members of a room, as RoomOccupants.
+
+    Rooms can have tens of thousands of members, so rather than making an occupant for all of them up front
+    we make them as they're asked for. The full member list is fetched from the homeserver the first time
+    it's needed, as sync only tells us about the members we've seen talking.
+    """
+
+    __slots__ = ("_room",)
+
+    def __init__(self, room: MatrixRoom):
+        self._room = room
+
+    def _users(self) -> tuple:
+        native = self._room._room
+        if not native.members_synced and self._room._backend is not None:
+            self._room._backend.load_members(self._room._id)
+        return tuple(native.users.values())
+
+    def __len__(self) -> int:
+        return len(self._users())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._room._occupant(user) for user in self._users()[index]]
+        return self._room._occupant(self._users()[index])
+
+    def __iter__(self):
+        for user in self._users():
+            yield self._room._occupant(user)
+
+    def __contains__(self, item) -> bool:
+        mxid = getattr(item, "_id", item)
+        return mxid in self._room._room.users or (
+            self._room.get_occupant(mxid) is not None
+        )
+
+
 class MatrixRoomOccupant(backend.Person, backend.RoomOccupant):
     """
     Representation of a particular user in particular room.
@@ -396,6 +2767,90 @@ MatrixMessageTypes = [
 ]
 
 
+def _content(event) -> dict:
+    return event.source.get("content", {})
+
+
+def _relation(event) -> dict:
+    return _content(event).get("m.relates_to") or {}
+
+
+class EventExtras(MutableMapping):
+    """The `extras` of a message from matrix.
+
+    These are read from the event's source when a plugin asks for them (and remembered), so messages nobody
+    looks at closely don't cost anything. Values are the event's own, not copies, so don't modify them.
+    Plugins can still add, replace or remove keys like they would with a dict."""
+
+    __slots__ = ("_event", "_values", "_removed")
+
+    FIELDS = {
+        "event_id": lambda event: event.event_id,
+        "sender": lambda event: event.sender,
+        "timestamp": lambda event: event.server_timestamp,
+        "decrypted": lambda event: event.decrypted,
+        # the old spelling, for plugins that used it
+        "decypted": lambda event: event.decrypted,
+        "verified": lambda event: event.verified,
+        "format": lambda event: _content(event).get("format"),
+        "formatted_body": lambda event: _content(event).get("formatted_body"),
+        "mentions": lambda event: _content(event).get("m.mentions"),
+        "relates_to": lambda event: _content(event).get("m.relates_to"),
+        "reply_to": lambda event: _relation(event)
+        .get("m.in_reply_to", {})
+        .get("event_id"),
+        "thread_id": lambda event: (
+            _relation(event).get("event_id")
+            if _relation(event).get("rel_type") == "m.thread"
+            else None
+        ),
+    }
+
+    def __init__(self, event: nio.events.room_events.Event):
+        self._event = event
+        self._values = dict()
+        self._removed = set()
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        if key not in self.FIELDS or key in self._removed:
+            raise KeyError(key)
+        value = self._values[key] = self.FIELDS[key](self._event)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        self._values[key] = value
+        self._removed.discard(key)
+
+    def __delitem__(self, key) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._values.pop(key, None)
+        if key in self.FIELDS:
+            self._removed.add(key)
+
+    def __contains__(self, key) -> bool:
+        if key in self.FIELDS:
+            return key not in self._removed
+        return key in self._values
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if key not in self._removed:
+                yield key
+        for key in list(self._values):
+            if key not in self.FIELDS:
+                yield key
+
+    def __len__(self) -> int:
+        added = sum(1 for key in self._values if key not in self.FIELDS)
+        return len(self.FIELDS) - len(self._removed) + added
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class MatrixMessage(backend.Message):
     """A representation of a chat message.
 
@@ -416,6 +2871,7 @@ class MatrixMessage(backend.Message):
         super().__init__(body, frm, to, parent, delayed, partial, extras, flow)
         self._msgtype = "m.text"
         self._content = dict()
+        self._trace = None
 
     def clone(self):
         msg = MatrixMessage(
@@ -430,6 +2886,7 @@ class MatrixMessage(backend.Message):
         )
         msg._msgtype = self._msgtype
         msg._content = self._content
+        msg._trace = self._trace
         return msg
 
     @property
@@ -502,6 +2959,229 @@ class MatrixMessage(backend.Message):
         return "{}".format(self.body)
 
 
+##
+# Compact forms of messages and identifiers, for handing them between processes (see ProcessDispatcher).
+#
+# These are plain tuples, so they pickle small and don't need this module to be importable by name. Rooms
+# carry a snapshot of what a worker needs to answer questions about them, the other side of a room only
+# needs the id, which it gets passed to `room_for(room_id, details)`.
+##
+
+
+def encode_room(room: MatrixRoom, *members: str) -> tuple:
+    native = room._room
+    if native is None:
+        return ("r", room._id, None)
+
+    users = tuple(
+        (user.user_id, user.display_name)
+        for user in map(native.users.get, members)
+        if user is not None
+    )
+    details = (
+        native.name,
+        native.canonical_alias,
+        native.topic,
+        (
+            native.joined_count,
+            native.invited_count,
+            native.summary and native.summary.heroes,
+        ),
+        native.power_levels.users,
+        users,
+    )
+    return ("r", room._id, details)
+
+
+def encode_value(value):
+    """The compact form of a message, identifier or anything else we can pickle as it is."""
+    if isinstance(value, MatrixMessage):
+        return encode_message(value)
+    if isinstance(value, MatrixRoom):
+        own = value._room.own_user_id if value._room else None
+        return encode_room(value, own)
+    if isinstance(value, MatrixRoomOccupant):
+        room = value._room
+        own = room._room.own_user_id if room._room else None
+        return ("o", value._id, encode_room(room, value._id, own))
+    if isinstance(value, MatrixPerson):
+        profile = value._profile
+        if isinstance(profile, MatrixProfile):
+            profile = (profile.full_name, profile.avatar_url, profile.extras)
+        else:
+            profile = None
+        return ("p", value._id, profile)
+    if isinstance(value, (list, tuple)):
+        return ("l", [encode_value(item) for item in value])
+    return ("v", value)
+
+
+def encode_message(msg: MatrixMessage) -> tuple:
+    frm = msg.frm
+    if isinstance(frm, MatrixRoomOccupant):
+        to = encode_room(msg.to, frm._id, msg.to._room and msg.to._room.own_user_id)
+        frm = ("o", frm._id, to)
+    else:
+        frm = encode_value(frm)
+        to = encode_value(msg.to)
+    return (
+        "m",
+        msg.body,
+        frm,
+        to,
+        dict(msg.extras),
+        msg.msgtype,
+        msg._content,
+        msg._trace,
+    )
+
+
+def decode_value(data, room_for):
+    """Turn something from encode_value back into what it was."""
+    kind = data[0]
+    if kind == "v":
+        return data[1]
+    if kind == "l":
+        return [decode_value(item, room_for) for item in data[1]]
+    if kind == "m":
+        _, body, frm, to, extras, msgtype, content, trace = data
+        msg = MatrixMessage(
+            body, decode_value(frm, room_for), decode_value(to, room_for), extras=extras
+        )
+        msg._msgtype = msgtype
+        msg._content = content
+        msg._trace = trace
+        return msg
+    if kind == "r":
+        return room_for(data[1], data[2])
+    if kind == "o":
+        room = decode_value(data[2], room_for)
+        native = room._room.users.get(data[1]) if room._room else None
+        if native is None:
+            return MatrixPerson(data[1])
+        return room._occupant(native)
+    if kind == "p":
+        profile = MatrixProfile(*data[2]) if data[2] else None
+        return MatrixPerson(data[1], profile)
+    raise ValueError("can't decode {!r}".format(kind))
+
+
+# a single line that markdown would just wrap in a paragraph: no inline markup, nothing that starts a
+# block (lists, quotes, headings, code) and no leading/trailing whitespace
+PLAIN_TEXT = re.compile(r"(?![\s=+>-]|\d+[.)])[^`*_\[\]<>&\\|~#\t\n]+(?<!\s)\Z")
+
+THUMBNAIL_SIZE = (800, 600)
+# roughly what an event's ids, keys and nio object cost, on top of its text
+EVENT_OVERHEAD = 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def file_digest(path: str) -> str:
+    """sha256 of a file, read in chunks so big files don't end up in memory."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def probe_image(path: str) -> dict:
+    """Work out what we need to know to send an image: size, hash, thumbnail and blurhash.
+
+    This reads (and decodes) the whole image, so it should be run on a worker thread rather than the
+    event loop."""
+    info = {"digest": file_digest(path), "size": os.path.getsize(path)}
+
+    with Image.open(path) as im:
+        info["w"], info["h"] = im.size
+
+        if im.width > THUMBNAIL_SIZE[0] or im.height > THUMBNAIL_SIZE[1]:
+            thumb = im.copy()
+            thumb.thumbnail(THUMBNAIL_SIZE)
+            if thumb.mode not in ("RGB", "L"):
+                thumb = thumb.convert("RGB")
+
+            data = io.BytesIO()
+            thumb.save(data, "JPEG", quality=80)
+            info["thumbnail"] = {
+                "data": data.getvalue(),
+                "digest": hashlib.sha256(data.getvalue()).hexdigest(),
+                "info": {
+                    "w": thumb.width,
+                    "h": thumb.height,
+                    "mimetype": "image/jpeg",
+                    "size": len(data.getvalue()),
+                },
+            }
+
+        if blurhash:
+            small = im.convert("RGB")
+            small.thumbnail((32, 32))
+            pixels = list(small.getdata())
+            rows = [
+                pixels[y * small.width : (y + 1) * small.width]
+                for y in range(small.height)
+            ]
+            info["blurhash"] = blurhash.encode(rows, components_x=4, components_y=3)
+
+    return info
+
+
+def describe_upload(source) -> dict:
+    """Work out how to upload a path, bytes or binary file object.
+
+    Returns what to give nio's upload, along with the sha256 and size of the content. Files are hashed in
+    chunks (and rewound afterwards), so this should be run on a worker thread."""
+    if isinstance(source, (bytes, bytearray)):
+        return {
+            "data": io.BytesIO(source),
+            "digest": hashlib.sha256(source).hexdigest(),
+            "size": len(source),
+            "filename": None,
+        }
+
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        return {
+            # passing nio a path means it streams the file rather than reading it all in
+            "data": lambda got_429, got_timeouts: path,
+            "digest": file_digest(path),
+            "size": os.path.getsize(path),
+            "filename": os.path.basename(path),
+        }
+
+    if not source.seekable():
+        return describe_upload(source.read())
+
+    start = source.tell()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    size = source.tell() - start
+    source.seek(start)
+
+    name = getattr(source, "name", None)
+    return {
+        "data": source,
+        "digest": digest.hexdigest(),
+        "size": size,
+        "filename": os.path.basename(name) if isinstance(name, str) else None,
+    }
+
+
+def event_size(event: nio.events.Event) -> int:
+    """A rough size for a cached event: its text, plus a fixed amount for everything else.
+
+    This is called for every event we sync, so it has to be cheap, which serialising the event isn't.
+    """
+    content = event.source.get("content", {})
+    return (
+        EVENT_OVERHEAD
+        + len(str(content.get("body", "")))
+        + len(str(content.get("formatted_body", "")))
+    )
+
+
 class MatrixBackendAsync(object):
     """Async-native backend code"""
 
@@ -509,60 +3189,316 @@ class MatrixBackendAsync(object):
         self._bot = bot
         self._client = client
         self._md = xhtml()
-        self._management = dict()
+        self._markdown = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="matrix-markdown"
+        )
+        self._rendered = LookupCache(
+            None,
+            maxsize=getattr(bot.bot_config, "MATRIX_RENDER_CACHE_SIZE", 512),
+            ttl=24 * 60 * 60,
+        )
+        self._send_order = dict()
 
-    def attach_callbacks(self):
-        self._client.add_event_callback(
-            self.on_message, nio.events.room_events.RoomMessageText
+        METRICS.add_collector(self.collect_metrics)
+        self._identities = IdentityMap(
+            client, bot, getattr(bot.bot_config, "MATRIX_OCCUPANT_CACHE_SIZE", 1024)
+        )
+        self._direct = DirectRoomIndex(client)
+        self._aliases = AliasIndex(client)
+        self._resolved_aliases = LookupCache(
+            self._resolve_alias,
+            maxsize=getattr(bot.bot_config, "MATRIX_ALIAS_CACHE_SIZE", 256),
+            ttl=getattr(bot.bot_config, "MATRIX_ALIAS_CACHE_TTL", 3600),
         )
-        self._client.add_event_callback(
-            self.on_unknown, nio.events.room_events.UnknownEvent
+        if getattr(bot.bot_config, "MATRIX_UPLOAD_CACHE", True):
+            self._uploads = UploadCache(
+                os.path.join(bot.bot_config.BOT_DATA_DIR, "matrix_uploads.db")
+            )
+        else:
+            self._uploads = UploadCache()
+        # encrypted uploads include the keys to decrypt them, so they're only ever kept in memory
+        self._encrypted_uploads = UploadCache()
+        self._events = LookupCache(
+            self._fetch_event,
+            maxsize=getattr(bot.bot_config, "MATRIX_EVENT_CACHE_SIZE", 2048),
+            maxbytes=getattr(
+                bot.bot_config, "MATRIX_EVENT_CACHE_BYTES", 8 * 1024 * 1024
+            ),
+            ttl=3600,
+            sizeof=event_size,
+        )
+        self._profiles = LookupCache(
+            self._fetch_profile,
+            maxsize=getattr(bot.bot_config, "MATRIX_PROFILE_CACHE_SIZE", 1024),
+            ttl=getattr(bot.bot_config, "MATRIX_PROFILE_CACHE_TTL", 300),
+        )
+        self._members = LookupCache(self._fetch_members, maxsize=1024, ttl=60)
+        self._joins = JoinQueue(
+            client,
+            allow=getattr(bot.bot_config, "MATRIX_INVITE_ALLOW", None),
+            deny=getattr(bot.bot_config, "MATRIX_INVITE_DENY", ()),
+            max_in_flight=getattr(bot.bot_config, "MATRIX_JOIN_MAX_IN_FLIGHT", 2),
+            max_retries=getattr(bot.bot_config, "MATRIX_JOIN_MAX_RETRIES", 5),
+        )
+
+        # optionally skip messages errbot would ignore, without doing any work on them
+        self._filter = None
+        if getattr(bot.bot_config, "MATRIX_COMMAND_FILTER", False):
+            self._filter = CommandFilter(bot)
+
+        # only sync what we (and the plugins) use
+        self.sync_filter = SyncFilter(
+            client,
+            bot,
+            enabled=getattr(bot.bot_config, "MATRIX_SYNC_FILTER", True),
+            lazy_load_members=getattr(bot.bot_config, "MATRIX_LAZY_LOAD_MEMBERS", True),
+            event_types=getattr(bot.bot_config, "MATRIX_SYNC_EVENT_TYPES", ()),
+            callbacks={
+                callback: types for callback, _, types in self.event_callbacks()
+            },
+        )
+
+        # keys for encrypted rooms, if the bot has been set up for them
+        self.crypto = None
+        if getattr(bot.bot_config, "MATRIX_E2EE", False):
+            self.crypto = CryptoSessions(
+                client,
+                ignore_unverified=getattr(
+                    bot.bot_config, "MATRIX_E2EE_IGNORE_UNVERIFIED", True
+                ),
+            )
+
+        # optionally trace where the time goes when handling a message
+        self._closed = False
+        self.tracer = None
+        trace_file = getattr(bot.bot_config, "MATRIX_TRACE_FILE", None)
+        trace_endpoint = getattr(bot.bot_config, "MATRIX_TRACE_ENDPOINT", None)
+        if trace_file or trace_endpoint:
+            self.tracer = Tracer(
+                sample_rate=getattr(bot.bot_config, "MATRIX_TRACE_SAMPLE_RATE", 0.1),
+                path=trace_file,
+                endpoint=trace_endpoint,
+                service=getattr(bot.bot_config, "MATRIX_TRACE_SERVICE", "errbot"),
+            )
+
+        self._dispatcher = CallbackDispatcher(
+            workers=getattr(bot.bot_config, "MATRIX_DISPATCH_WORKERS", 8),
+            queue_size=getattr(bot.bot_config, "MATRIX_DISPATCH_QUEUE_SIZE", 256),
+            overflow=getattr(bot.bot_config, "MATRIX_DISPATCH_OVERFLOW", "block"),
         )
-        self._client.add_event_callback(
-            self.on_invite, nio.events.invite_events.InviteEvent
+
+        # optionally handle messages in other processes, so CPU-heavy plugins don't hold us up
+        self.processes = None
+        self._callback_message = bot.callback_message
+        if getattr(bot.bot_config, "MATRIX_DISPATCH_PROCESSES", 0):
+            self.processes = ProcessDispatcher(
+                bot,
+                processes=bot.bot_config.MATRIX_DISPATCH_PROCESSES,
+                timeout=getattr(bot.bot_config, "MATRIX_WORKER_TIMEOUT", 300),
+            )
+            self._callback_message = self.processes.callback_message
+        self._sender = SendScheduler(
+            client,
+            rate=getattr(bot.bot_config, "MATRIX_SEND_RATE", 5.0),
+            burst=getattr(bot.bot_config, "MATRIX_SEND_BURST", 10),
+            max_in_flight=getattr(bot.bot_config, "MATRIX_SEND_MAX_IN_FLIGHT", 4),
+            max_retries=getattr(bot.bot_config, "MATRIX_SEND_MAX_RETRIES", 5),
+            crypto=self.crypto,
+            tracer=self.tracer,
+        )
+
+        # everything we send goes via the outbox, which can merge bursts of messages if asked to
+        self._outbox = self._sender
+        coalesce_window = getattr(bot.bot_config, "MATRIX_COALESCE_WINDOW", 0)
+        if coalesce_window:
+            self._outbox = MessageCoalescer(
+                self._sender,
+                window=coalesce_window,
+                max_size=getattr(bot.bot_config, "MATRIX_COALESCE_MAX_SIZE", 16000),
+            )
+
+    def event_callbacks(self) -> list:
+        """Our event callbacks, with the nio events they're for and the event types we need synced for them."""
+        events = nio.events.room_events
+        return [
+            (self.on_message, events.RoomMessageText, ["m.room.message"]),
+            (self.on_unknown, events.UnknownEvent, ["m.reaction"]),
+            (self.on_invite, nio.events.invite_events.InviteEvent, []),
+            (self.on_undecrypted, events.MegolmEvent, ["m.room.encrypted"]),
+            (self.on_member, events.RoomMemberEvent, ["m.room.member"]),
+        ]
+
+    async def close(self) -> None:
+        """Stop everything we started, when the bot is shutting down."""
+        if self._closed:
+            return
+        self._closed = True
+        METRICS.remove_collector(self.collect_metrics)
+        if self.processes:
+            self.processes.stop()
+        if self.tracer:
+            await self.tracer.close()
+
+    def attach_callbacks(self):
+        for callback, event_class, _ in self.event_callbacks():
+            self._client.add_event_callback(callback, event_class)
+        self._client.add_response_callback(self.on_sync, nio.responses.SyncResponse)
+        self._client.add_global_account_data_callback(
+            self.on_account_data, nio.events.account_data.UnknownAccountDataEvent
         )
 
-    def _format(self, msg):
+    async def build_indexes(
+        self,
+        response: nio.responses.SyncResponse,
+        aliases: Optional[Dict[str, dict]] = None,
+    ) -> None:
+        """Build our indexes of rooms once we've done the initial sync.
+
+        `aliases` is what the state store remembers of each room's aliases, see AliasIndex.rebuild.
+        """
+        self._aliases.rebuild(aliases)
+        await self.on_sync(response)
+        await self.load_direct_rooms()
+
+    async def load_direct_rooms(self) -> None:
+        """Build the index of private rooms."""
+        response = await self._client.list_direct_rooms()
+        if isinstance(response, nio.responses.DirectRoomsResponse):
+            self._direct.rebuild(response.rooms)
+        else:
+            log.debug("no m.direct account data: %s", response)
+            self._direct.rebuild()
+
+    def collect_metrics(self) -> dict:
+        """Gauges for the metrics registry, from the stats we already keep."""
+        gauges = dict()
+        for cache, stats in self.cache_stats().items():
+            for stat, value in stats.items():
+                gauges[("matrix_cache_" + stat, (("cache", cache),))] = value
+        for stat, value in self.dispatch_stats().items():
+            gauges[("matrix_dispatch_" + stat, ())] = value
+        for stat, value in self.send_stats().items():
+            gauges[("matrix_send_" + stat, ())] = value
+        for stat, value in self.filter_stats().items():
+            gauges[("matrix_command_filter_" + stat, ())] = value
+        for stat, value in self._joins.stats().items():
+            gauges[("matrix_join_" + stat, ())] = value
+        for stat, value in self.sync_filter.stats().items():
+            gauges[("matrix_sync_filter_" + stat, ())] = value
+        for stat, value in (self.crypto.stats() if self.crypto else {}).items():
+            gauges[("matrix_crypto_" + stat, ())] = value
+        for stat, value in (self.processes.stats() if self.processes else {}).items():
+            gauges[("matrix_dispatch_process_" + stat, ())] = value
+        for stat, value in (self.tracer.stats() if self.tracer else {}).items():
+            gauges[("matrix_trace_" + stat, ())] = value
+        return gauges
+
+    def cache_stats(self) -> dict:
+        """Hit/miss counters for the backend's caches."""
+        return {
+            "profile": self._profiles.stats(),
+            "member": self._members.stats(),
+            "identity": self._identities.stats(),
+            "direct": self._direct.stats(),
+            "alias": self._aliases.stats(),
+            "resolved_alias": self._resolved_aliases.stats(),
+            "event": self._events.stats(),
+            "upload": self._uploads.stats(),
+            "encrypted_upload": self._encrypted_uploads.stats(),
+            "render": self._rendered.stats(),
+        }
+
+    def dispatch_stats(self) -> dict:
+        """Queue depth and wait times for events being handed to errbot."""
+        return self._dispatcher.stats()
+
+    def filter_stats(self) -> dict:
+        """How many messages the command filter let through or skipped."""
+        return self._filter.stats() if self._filter else {}
+
+    def plugins_changed(self) -> None:
+        self.sync_filter.plugins_changed()
+        if self._filter:
+            self._filter.plugins_changed()
+
+    def send_stats(self) -> dict:
+        """Counters for outgoing events."""
+        return self._outbox.stats()
+
+    async def _format(self, msg):
         """Inject the HMTL version of a plain message"""
         if msg["msgtype"] == "m.text" and "format" not in msg:
             msg["format"] = "org.matrix.custom.html"
-            msg["formatted_body"] = self._md.convert(msg["body"])
+            msg["formatted_body"] = await self._render(msg["body"])
         return msg
 
-    def _annotate_event(self, event: nio.events.room_events.Event, extras: dict):
-        extras["event_id"] = event.event_id
-        extras["sender"] = event.sender
-        extras["timestamp"] = event.server_timestamp
-        extras["decypted"] = event.decrypted
-        extras["verified"] = event.verified
+    async def _render(self, text: str) -> str:
+        """Convert markdown to HTML.
+
+        Plain text doesn't need markdown at all. Everything else is rendered on a separate thread (the
+        markdown object isn't thread safe, so only one) and cached, because help and status output gets
+        sent over and over."""
+        if PLAIN_TEXT.match(text):
+            return "<p>{}</p>".format(text)
+
+        loop = asyncio.get_event_loop()
+        return await self._rendered.get(
+            hashlib.sha256(text.encode()).digest(),
+            lambda key: loop.run_in_executor(self._markdown, self._md.convert, text),
+        )
 
-        # message type data
-        if isinstance(event, nio.events.room_events.RoomMessage):
-            source = event.flattened()
-            log.debug("%s", source)
+    def _annotate_event(self, event: nio.events.room_events.Event) -> EventExtras:
+        """The extras for a message, which are only read from the event when they're used."""
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s", event.flattened())
+        return EventExtras(event)
 
     async def on_message(self, room, event: nio.events.room_events.RoomMessageText):
         """Callback for handling matrix messages"""
 
         try:
+            callback = self._callback_message
+            if self._filter:
+                route = self._filter.route(room, event)
+                if route is None:
+                    return
+                if route == CommandFilter.LISTENERS and not self.processes:
+                    callback = self._notify_listeners
+
+            trace = self.tracer and self.tracer.start()
+            received = time.time()
             log.info("got a message")
-            err_room = MatrixRoom(room.room_id, self._client)
+            err_room = self._identities.room(room.room_id)
 
             # because (presumably XMPP) the core bot plugins make assumptions about occupants
             if not err_room.is_private:
+                await self.load_member(room.room_id, event.sender)
                 err_sender = err_room.get_occupant(event.sender)
             else:
                 err_sender = await self.get_matrix_person(event.sender)
 
-            msg = MatrixMessage(event.body, err_sender, err_room)
-            self._annotate_event(event, msg.extras)
-            await self._bot.loop.run_in_executor(None, self._bot.callback_message, msg)
-        except Exception as e:
-            log.warning("something went wrong processing a message... %s", e)
-            import traceback
+            msg = MatrixMessage(
+                event.body, err_sender, err_room, extras=self._annotate_event(event)
+            )
+            if trace:
+                self.tracer.record("matrix.get_sender", trace, received, time.time())
+            await self._dispatch(room.room_id, callback, msg, event, trace, received)
+        except Exception:
+            log.exception("something went wrong processing a message...")
+            METRICS.inc("matrix_exceptions_total", handler="on_message")
 
-            track = traceback.format_exc()
-            print(track)
+    def _notify_listeners(self, msg: "MatrixMessage") -> None:
+        """The lightweight path for messages the command filter says can't be commands.
+
+        They go straight to the plugins that listen to every message, errbot doesn't look for a command.
+        """
+        if self._bot.is_from_self(msg):
+            return
+        for plugin in self._filter.listeners():
+            try:
+                plugin.callback_message(msg)
+            except Exception:
+                log.exception("callback_message on %s crashed.", plugin.name)
 
     async def on_unknown(self, room, event: nio.events.room_events.UnknownEvent):
         """Callback for unknown events"""
@@ -577,8 +3513,10 @@ class MatrixBackendAsync(object):
 
         This isn't offical yet, so rather than a 'real' callback I'm simulating it."""
         try:
+            trace = self.tracer and self.tracer.start()
+            received = time.time()
             fields = event.source
-            err_room = MatrixRoom(room.room_id, self._client)
+            err_room = self._identities.room(room.room_id)
 
             reactor = await self.get_matrix_person(fields["sender"])
             if reactor == self._bot.bot_identifier:
@@ -589,186 +3527,549 @@ class MatrixBackendAsync(object):
             reaction_name = fields["content"]["m.relates_to"]["key"]
 
             # find the original
-            event2 = await self._client.room_get_event(
-                room.room_id, fields["content"]["m.relates_to"]["event_id"]
+            original = await self._events.get(
+                (room.room_id, fields["content"]["m.relates_to"]["event_id"])
             )
-            if not isinstance(event2, nio.responses.RoomGetEventResponse):
-                log.warning("got %s rather than RoomGetEventResponse", event2)
+            if not original:
                 return
 
-            reacted_to = {"source": event2.event.source, "room": err_room}
-            reacted_to_owner = await self.get_matrix_person(event2.event.sender)
+            reacted_to = {"source": original.source, "room": err_room}
+            reacted_to_owner = await self.get_matrix_person(original.sender)
 
             reaction = backend.Reaction(
                 reactor, reacted_to_owner, action, timestamp, reaction_name, reacted_to
             )
-            await self._bot.loop.run_in_executor(
-                None, self._bot.callback_reaction, reaction
+            if trace:
+                self.tracer.record("matrix.get_sender", trace, received, time.time())
+            await self._dispatch(
+                room.room_id,
+                self._bot.callback_reaction,
+                reaction,
+                event,
+                trace,
+                received,
+            )
+        except Exception:
+            log.exception("something went wrong processing a reaction...")
+            METRICS.inc("matrix_exceptions_total", handler="on_reaction")
+
+    async def _dispatch(self, room_id: str, callback, item, event, trace, received):
+        """Hand something to errbot, as part of `trace` if the event is being traced."""
+        if not trace:
+            return await self._dispatcher.submit(room_id, callback, item)
+
+        arrived = self._client.received_at or received
+        self.tracer.record("matrix.sync", trace, arrived, received)
+        attributes = {
+            "room_id": room_id,
+            "event_id": event.event_id,
+            "event_type": event.source.get("type", ""),
+            "event_age_ms": int(received * 1000) - event.server_timestamp,
+        }
+        return await self._dispatcher.submit(
+            room_id,
+            self._traced,
+            callback,
+            item,
+            trace,
+            arrived,
+            time.time(),
+            attributes,
+        )
+
+    def _traced(self, callback, item, trace, began, queued, attributes) -> None:
+        """Run a dispatch callback (on one of the dispatch threads) as part of a trace."""
+        started = time.time()
+        self.tracer.record("matrix.dispatch_queue", trace, queued, started)
+
+        # anything sent from here on is part of the trace, including replies errbot makes on other threads
+        trace = (trace[0], trace[1], started)
+        if isinstance(item, MatrixMessage):
+            item._trace = trace
+        token = TRACE_CONTEXT.set(trace)
+        try:
+            callback(item)
+        finally:
+            TRACE_CONTEXT.reset(token)
+            finished = time.time()
+            self.tracer.record("errbot.callback", trace, started, finished)
+            self.tracer.record(
+                "matrix.event", trace, began, finished, root=True, **attributes
             )
-        except Exception as e:
-            log.warning("something went wrong processing a reaction... %s", e)
-            import traceback
 
-            track = traceback.format_exc()
-            print(track)
+    def _resume_trace(self, msg) -> Optional[tuple]:
+        """Pick up the trace a message we're sending (or reacting to) is part of, for the rest of this task.
+
+        The time since errbot was handed the event is how long the plugin took to get here.
+        """
+        if not self.tracer:
+            return None
+        trace = getattr(msg, "_trace", None) or TRACE_CONTEXT.get()
+        if trace:
+            TRACE_CONTEXT.set(trace)
+            if trace[2]:
+                self.tracer.record("errbot.plugin", trace, trace[2], time.time())
+        return trace
+
+    async def on_undecrypted(self, room, event: nio.events.room_events.MegolmEvent):
+        """Callback for encrypted events nio couldn't decrypt, usually because we don't have the key yet."""
+        log.warning("couldn't decrypt %s in %s", event.event_id, room.room_id)
+        if self.crypto:
+            try:
+                await self.crypto.undecrypted(event)
+            except Exception:
+                log.exception("error requesting a room key")
+                METRICS.inc("matrix_exceptions_total", handler="on_undecrypted")
 
     async def on_invite(
         self, room, event: nio.events.invite_events.InviteEvent
     ) -> None:
-        """Callback for handling room invites"""
-        await self._client.join(room.room_id)
+        """Callback for handling room invites.
+
+        We get the whole invite state, but only the invite itself (of us) means anything. The join happens
+        in the background so a flood of invites doesn't hold up the sync loop."""
+        if not isinstance(event, nio.events.invite_events.InviteMemberEvent):
+            return
+        if event.state_key == self._client.user_id and event.membership == "invite":
+            self._joins.invited(room.room_id, event.sender)
+
+    async def on_member(self, room, event: nio.events.room_events.RoomMemberEvent):
+        """Callback for membership changes.
+
+        Display name and avatar changes are sent as member events, so this is how we find out that a cached
+        profile is out of date."""
+        if event.membership != event.prev_membership:
+            self._direct.on_room_changed(room)
+            if event.state_key == self._client.user_id:
+                self._identities.forget_room(room.room_id)
+            else:
+                self._identities.forget_member(room.room_id, event.state_key)
+
+        prev = event.prev_content or {}
+        for key in ("displayname", "avatar_url"):
+            if event.content.get(key) != prev.get(key):
+                self._profiles.invalidate(event.state_key)
+                return
 
-    async def get_profile(self, user: str) -> dict:
+    async def on_sync(self, response: nio.responses.SyncResponse):
+        """Callback for sync responses, used to keep our room indexes and event cache up to date."""
+        if response.elapsed:
+            METRICS.observe("matrix_sync_seconds", response.elapsed)
+
+        batch = 0
+        for room_id, info in response.rooms.join.items():
+            batch += len(info.timeline.events)
+            for event in info.timeline.events:
+                event_type = event.source.get("type")
+                if event_type not in COUNTED_EVENT_TYPES:
+                    event_type = "other"
+                METRICS.inc("matrix_events_total", type=event_type)
+
+            for event in info.state + info.timeline.events:
+                if isinstance(event, nio.events.room_events.RoomAliasEvent):
+                    self._aliases.update(room_id, event.source.get("content", {}))
+
+            # keep recent events around, in case someone reacts to them
+            for event in info.timeline.events:
+                if getattr(event, "event_id", None):
+                    self._events.put((room_id, event.event_id), event)
+
+        for room_id in response.rooms.leave:
+            self._direct.forget_room(room_id)
+            self._aliases.forget_room(room_id)
+            self._identities.forget_room(room_id)
+
+        METRICS.observe("matrix_sync_batch_events", batch)
+
+    async def on_account_data(self, event):
+        """Callback for global account data, we only care about `m.direct`."""
+        if event.type == "m.direct":
+            self._direct.update_direct(event.content)
+
+    async def _fetch_event(self, key):
+        room_id, event_id = key
+        response = await self._client.room_get_event(room_id, event_id)
+        if not isinstance(response, nio.responses.RoomGetEventResponse):
+            count_error(response)
+            log.warning("got %s rather than RoomGetEventResponse", response)
+            return None
+        return response.event
+
+    async def _fetch_profile(self, user: str) -> Optional[MatrixProfile]:
         response = await self._client.get_profile(user)
         if isinstance(response, nio.responses.ProfileGetError):
+            count_error(response)
             log.warning("error getting profile data for user: %s", response)
-            return MatrixProfile()
+            return None
         else:
             log.debug("extra info %s is %s", user, response.other_info)
             return MatrixProfile(
                 response.displayname, response.avatar_url, response.other_info
             )
 
+    async def get_profile(self, user: str) -> MatrixProfile:
+        profile = await self._profiles.get(user)
+        if not profile:
+            return MatrixProfile(None, None, {})
+        return profile
+
+    def get_room(self, room_id: str) -> MatrixRoom:
+        """Get the (shared) MatrixRoom for a room id."""
+        return self._identities.room(room_id)
+
     async def get_matrix_person(self, mxid: str) -> MatrixPerson:
         profile = await self.get_profile(mxid)
         return MatrixPerson(mxid, profile)
 
-    async def get_private_channel(self, user):
-        # FIXME this feels super hacky >.<
+    async def load_member(self, room_id: str, user_id: str) -> bool:
+        """Make sure nio knows about a room member, fetching them if we haven't seen them yet.
 
-        # do we have a cached management room?
-        if user._id in self._management:
-            log.debug("had cached management room: %s", self._management[user._id])
-            return self._management[user._id]
+        Returns False if they aren't in the room."""
+        room = self._client.rooms.get(room_id)
+        if room is None:
+            return False
+        if user_id in room.users or room.members_synced:
+            return user_id in room.users
+
+        await self._members.get((room_id, user_id))
+        return user_id in room.users
+
+    async def load_members(self, room_id: str) -> None:
+        """Fetch the full member list of a room (sync only gives us the members we've seen talking)."""
+        room = self._client.rooms.get(room_id)
+        if room is not None and not room.members_synced:
+            await self._members.get((room_id, None))
+
+    async def _fetch_members(self, key) -> Optional[bool]:
+        """Fetch one member of a room, or all of them if user_id is None.
+
+        nio adds the members to its room from the joined_members response, we add single members
+        ourselves."""
+        room_id, user_id = key
+        if user_id is None:
+            response = await self._client.joined_members(room_id)
+        else:
+            response = await self._client.room_get_state_event(
+                room_id, "m.room.member", user_id
+            )
+        if isinstance(response, nio.responses.ErrorResponse):
+            count_error(response)
+            log.debug("couldn't load members of %s: %s", room_id, response)
+            return None
 
-        # if not, we need to try and find a suitable one
-        log.debug("no cached management room, long route")
+        room = self._client.rooms.get(room_id)
+        if user_id is None or room is None:
+            return True
 
-        try:
-            for (rid, room) in self._client.rooms.items():
-                if not room.is_group or room.member_count != 2:
-                    continue
+        membership = response.content.get("membership")
+        if membership in ("join", "invite"):
+            room.add_member(
+                user_id,
+                response.content.get("displayname"),
+                response.content.get("avatar_url"),
+                invited=membership == "invite",
+            )
+        return True
 
-                if user._id in room.users:
-                    log.debug("found candidate management room, using that.")
-                    self._management[user._id] = room.room_id
-                    return room.room_id
-        except Exception as e:
-            log.debug("EXCEPTION DEEP IN ASYNC CODE! %s", e)
+    def room_for_alias(self, alias: str) -> Optional[str]:
+        """Get the room id for an alias of a room we're in (without asking the homeserver)."""
+        return self._aliases.lookup(alias)
 
-        # no suitable room? make one!
-        log.debug("no suitable room, making new one!")
-        new_room = await self._client.room_create(is_direct=True, invite=[user._id])
+    async def resolve_alias(self, alias: str) -> Optional[str]:
+        """Get the room id for any alias, asking the homeserver if it's not one of our rooms."""
+        return self._aliases.lookup(alias) or await self._resolved_aliases.get(alias)
 
-        if isinstance(new_room, nio.responses.RoomCreateResponse):
-            self._management[user._id] = new_room.room_id
-            return new_room.room_id
-        else:
-            log.warning("could not create management room: %s", new_room)
-            raise Exception("couldn't create management room")
+    async def _resolve_alias(self, alias: str) -> Optional[str]:
+        response = await self._client.room_resolve_alias(alias)
+        if isinstance(response, nio.responses.RoomResolveAliasError):
+            count_error(response)
+            log.debug("couldn't resolve alias %s: %s", alias, response)
+            return None
+        return response.room_id
+
+    async def get_private_channel(self, user):
+        """Get (or create) the room we use to talk privately to a user."""
+        return await self._direct.get_or_create(user._id)
 
     async def _get_room_id(self, msg):
-        target = msg.to
-        if isinstance(msg.to, str):
-            target = self._bot.build_identifier(target)
+        return await self._room_id_for(msg.to)
+
+    async def _room_id_for(self, target) -> str:
+        if isinstance(target, str):
+            target = self._bot.build_identifier(target) or target
+        if isinstance(target, str):
+            raise ValueError("not a room we're in, or a user: {}".format(target))
 
         if isinstance(target, MatrixPerson):
             # sending to a person? find/create a management channel
-            target = await self.get_private_channel(msg.to)
+            return await self.get_private_channel(target)
         else:
             # sending to a room? just do it directly
-            target = target._id
+            return target._id
 
-        return target
+    async def _queue(self, target: str, body) -> asyncio.Future:
+        """Queue a message for a room, returns a future for the response.
 
-    async def send_message(self, msg: backend.Message) -> None:
-        """Send a errbot-style message to matrix"""
+        `body` can be a coroutine that renders the message. Rendering can take a while, but messages for a
+        room still need to be queued in the order they were sent."""
+        queued = asyncio.get_event_loop().create_future()
+        previous = self._send_order.get(target)
+        self._send_order[target] = queued
+        try:
+            if asyncio.iscoroutine(body):
+                body = await body
+            if previous:
+                await asyncio.shield(previous)
+            return self._outbox.send(target, "m.room.message", body)
+        finally:
+            if not queued.done():
+                queued.set_result(None)
+            if self._send_order.get(target) is queued:
+                del self._send_order[target]
+
+    async def _render_message(self, msg: backend.Message) -> dict:
+        started = time.time()
+        body = await self._format({"msgtype": msg.msgtype, "body": msg.body})
+        body.update(msg._content)
+
+        trace = TRACE_CONTEXT.get()
+        if trace and self.tracer:
+            self.tracer.record("matrix.format", trace, started, time.time())
+        return body
+
+    async def send_message(self, msg: backend.Message):
+        """Send a errbot-style message to matrix
+
+        Returns the nio response once the message has been sent, or None if we couldn't
+        send it."""
 
         log.debug("sending message %s to: %s", msg, msg.to)
 
+        self._resume_trace(msg)
+
         try:
             # try to figure out where the message has to go...
             target = await self._get_room_id(msg)
+            result = await (await self._queue(target, self._render_message(msg)))
+
+            if isinstance(result, nio.responses.RoomSendError):
+                log.warning("message didn't send properly: %s", result)
+            return result
+        except Exception:
+            log.exception("error in send_message")
+            METRICS.inc("matrix_exceptions_total", handler="send_message")
+
+    async def broadcast(
+        self, msg: backend.Message, targets: list, concurrency: int = 16
+    ) -> dict:
+        """Send the same message to lots of rooms (or people).
+
+        The message is rendered once, and at most `concurrency` rooms are waiting on their message at a
+        time (the send rate limits still apply on top of that). Returns a summary keyed by target, with the
+        room id and either the event id or the error for each."""
+        body = await self._render_message(msg)
+        limit = asyncio.Semaphore(concurrency)
+
+        async def send_to(target) -> dict:
+            async with limit:
+                room_id = None
+                try:
+                    room_id = await self._room_id_for(target)
+                    result = await (await self._queue(room_id, dict(body)))
+                except Exception as e:
+                    log.warning("couldn't broadcast to %s: %s", target, e)
+                    result = e
+
+                if isinstance(result, nio.responses.RoomSendResponse):
+                    METRICS.inc("matrix_broadcast_total", result="sent")
+                    return {"room_id": room_id, "event_id": result.event_id}
+                METRICS.inc("matrix_broadcast_total", result="failed")
+                return {"room_id": room_id, "error": str(result)}
+
+        results = await asyncio.gather(*(send_to(target) for target in targets))
+        return {
+            getattr(target, "_id", target): result
+            for target, result in zip(targets, results)
+        }
+
+    async def upload(
+        self,
+        data,
+        digest: str,
+        content_type: str,
+        filename: str,
+        size: int,
+        encrypt: bool = False,
+    ):
+        """Upload something to the content repository, and return its mxc url.
+
+        `data` is anything nio's upload accepts. With `encrypt` it's encrypted first, for an encrypted room,
+        and what's returned is the `file` object for the event (the url and the keys to decrypt it).
+        Uploads are remembered by their sha256 (`digest`) so sending the same file again doesn't upload it
+        again, plain and encrypted uploads of the same file are remembered separately. Encrypted ones are only
+        remembered until we restart, so the keys are never written to disk.
+        """
+        uploads = self._encrypted_uploads if encrypt else self._uploads
+        cached = uploads.get(digest)
+        if cached:
+            return json.loads(cached) if encrypt else cached
+
+        started = time.monotonic()
+        resp, keys = await self._client.upload(
+            data,
+            content_type=content_type,
+            filename=filename,
+            encrypt=encrypt,
+            filesize=size,
+        )
+        METRICS.observe("matrix_upload_seconds", time.monotonic() - started)
+        if not isinstance(resp, nio.responses.UploadResponse):
+            count_error(resp)
+            log.debug("Error uploading %s: %s", filename, resp)
+            raise Exception("{} didn't upload :(".format(filename))
+
+        if encrypt:
+            file = dict(keys, url=resp.content_uri)
+            uploads.put(digest, json.dumps(file))
+            return file
+        uploads.put(digest, resp.content_uri)
+        return resp.content_uri
+
+    def _is_encrypted(self, room_id: str) -> bool:
+        room = self._client.rooms.get(room_id)
+        return room is not None and room.encrypted
+
+    async def send_file(
+        self,
+        room,
+        source,
+        filename: str = None,
+        content_type: str = None,
+        msgtype: str = None,
+        body: str = None,
+        info: dict = None,
+    ):
+        """Upload and send a file.
 
-            body = self._format({"msgtype": msg.msgtype, "body": msg.body})
-            body.update(msg._content)
+        `source` can be a path, bytes or a binary file object. The message type (m.file, m.audio,
+        m.video or m.image) is worked out from the content type unless you give one. Anything in `info`
+        (eg, duration, w, h) is added to the event's info.
+        """
+        try:
+            upload = await asyncio.get_event_loop().run_in_executor(
+                None, describe_upload, source
+            )
 
-            result = await self._client.room_send(
-                room_id=target, message_type="m.room.message", content=body
+            filename = filename or upload["filename"] or "file"
+            content_type = (
+                content_type
+                or mimetypes.guess_type(filename)[0]
+                or "application/octet-stream"
+            )
+            if not msgtype:
+                msgtype = "m.file"
+                for kind in ("image", "audio", "video"):
+                    if content_type.startswith(kind + "/"):
+                        msgtype = "m." + kind
+
+            encrypted = self._is_encrypted(room._id)
+            uploaded = await self.upload(
+                upload["data"],
+                upload["digest"],
+                content_type,
+                filename,
+                upload["size"],
+                encrypt=encrypted,
             )
 
-            if isinstance(result, nio.responses.RoomSendError):
-                log.warning("message didn't send properly")
-        except Exception as e:
-            import traceback
+            content = {
+                "msgtype": msgtype,
+                "body": body or filename,
+                "filename": filename,
+                "file" if encrypted else "url": uploaded,
+                "info": {"mimetype": content_type, "size": upload["size"]},
+            }
+            if info:
+                content["info"].update(info)
 
-            track = traceback.format_exc()
-            print(track)
-            log.debug("error: %s", e)
+            return await self._outbox.send(room._id, "m.room.message", content)
+        except Exception as e:
+            log.debug("Error sending file, %s", e)
 
     async def send_image(self, room, image):
         try:
             mime_type = mimetypes.guess_type(image)[0]
-            if not mime_type.startswith("image/"):
+            if not mime_type or not mime_type.startswith("image/"):
                 raise Exception("that was not an image!")
 
-            im = Image.open(image)
-            (width, height) = im.size
-
-            # we need an mxc for the next step
-            file_stat = await aiofiles.os.stat(image)
-            async with aiofiles.open(image, "r+b") as f:
-                resp, maybe_keys = await self._client.upload(
-                    f,
-                    content_type=mime_type,
-                    filename=os.path.basename(image),
-                    filesize=file_stat.st_size,
+            # decoding the image and making thumbnails is slow, keep it off the event loop
+            probe = await asyncio.get_event_loop().run_in_executor(
+                None, probe_image, image
+            )
+
+            # passing nio a path means it streams the file rather than reading it all in
+            encrypted = self._is_encrypted(room._id)
+            uploaded = await self.upload(
+                lambda got_429, got_timeouts: image,
+                probe["digest"],
+                mime_type,
+                os.path.basename(image),
+                probe["size"],
+                encrypt=encrypted,
+            )
+
+            info = {
+                "size": probe["size"],
+                "mimetype": mime_type,
+                "w": probe["w"],
+                "h": probe["h"],
+            }
+
+            thumb = probe.get("thumbnail")
+            if thumb:
+                thumbnail = await self.upload(
+                    io.BytesIO(thumb["data"]),
+                    thumb["digest"],
+                    thumb["info"]["mimetype"],
+                    "thumbnail.jpg",
+                    thumb["info"]["size"],
+                    encrypt=encrypted,
                 )
-                if not isinstance(resp, nio.responses.UploadResponse):
-                    log.debug("Error uploading image: %s", resp)
-                    raise Exception("image didn't upload :(")
-
-                content = {
-                    "body": os.path.basename(image),
-                    "info": {
-                        "size": file_stat.st_size,
-                        "mimetype": mime_type,
-                        "thumbnail_info": None,
-                        "w": width,
-                        "h": height,
-                        "thumbnail_url": None,
-                    },
-                    "msgtype": "m.image",
-                    "url": resp.content_uri,
-                }
+                info["thumbnail_file" if encrypted else "thumbnail_url"] = thumbnail
+                info["thumbnail_info"] = thumb["info"]
+
+            if "blurhash" in probe:
+                # MSC2448, what element uses for placeholders
+                info["xyz.amorgan.blurhash"] = probe["blurhash"]
+
+            content = {
+                "body": os.path.basename(image),
+                "info": info,
+                "msgtype": "m.image",
+                "file" if encrypted else "url": uploaded,
+            }
 
-                try:
-                    await self._client.room_send(
-                        room._id, message_type="m.room.message", content=content
-                    )
-                except Exception as e:
-                    log.debug("Error sending image, %s", e)
+            return await self._outbox.send(room._id, "m.room.message", content)
         except Exception as e:
             log.debug("Error sending image, %s", e)
 
-    async def send_reaction(self, msg, reaction) -> None:
+    async def send_reaction(self, msg, reaction):
         """Try to send an MSC2677 reaction to a message.
 
         This isn't technically part of the spec, but it is in element, so should be displayed."""
         if not msg.event_id:
             raise Exception("cannot react to a message that wasn't sent from matrix!")
 
+        self._resume_trace(msg)
+
         try:
             target = await self._get_room_id(msg)
             return await self.annotate_event(target, msg.event_id, reaction)
-        except Exception as e:
-            import traceback
+        except Exception:
+            log.exception("error in send_reaction")
+            METRICS.inc("matrix_exceptions_total", handler="send_reaction")
 
-            track = traceback.format_exc()
-            print(track)
-            log.debug("error: %s", e)
-
-    async def annotate_event(self, room_id, event_id, reaction) -> None:
+    async def annotate_event(self, room_id, event_id, reaction):
         """Try to send an MSC2677 annotation to an event.
 
         This is a bit more risky that passing a message, because you can react to things that are not
@@ -782,17 +4083,13 @@ class MatrixBackendAsync(object):
                     "key": reaction,
                 }
             }
-            result = await self._client.room_send(
-                room_id=room_id, message_type="m.reaction", content=body
-            )
+            result = await self._outbox.send(room_id, "m.reaction", body)
             if isinstance(result, nio.responses.RoomSendError):
                 log.warning("reaction didn't send properly: %s", result)
-        except Exception as e:
-            import traceback
-
-            track = traceback.format_exc()
-            print(track)
-            log.debug("error: %s", e)
+            return result
+        except Exception:
+            log.exception("error in annotate_event")
+            METRICS.inc("matrix_exceptions_total", handler="annotate_event")
 
     async def whoami(self) -> MatrixPerson:
         response = await self._client.whoami()
@@ -805,6 +4102,11 @@ class MatrixBackendAsync(object):
 
 class MatrixBackend(ErrBot):
     def __init__(self, config):
+        # commands run on our dispatch threads (MATRIX_DISPATCH_WORKERS), not errbot's own pool, or they'd
+        # escape the dispatcher's queue limit and per-room ordering as soon as errbot had queued them
+        if getattr(config, "BOT_ASYNC", False):
+            log.info("BOT_ASYNC is ignored, commands are run by the matrix dispatcher")
+        config.BOT_ASYNC = False
         super().__init__(config)
 
         self.homeserver = config.BOT_IDENTITY["homeserver"]
@@ -826,6 +4128,46 @@ class MatrixBackend(ErrBot):
         self._client = None
         self._async = None
 
+        # optional on-disk copy of the sync state, so restarts don't need a full sync
+        self._state_store = None
+        if getattr(config, "MATRIX_STATE_STORE", False):
+            self._state_store = MatrixStateStore(
+                os.path.join(config.BOT_DATA_DIR, "matrix_state.db")
+            )
+
+        # optional end to end encryption, keys are kept in a sqlite database in the data dir
+        self._e2ee = getattr(config, "MATRIX_E2EE", False)
+        if self._e2ee and not nio.crypto.ENCRYPTION_ENABLED:
+            log.fatal(
+                "MATRIX_E2EE needs the encryption extras for matrix-nio"
+                "You can do `pip install matrix-nio[e2e]` to install them"
+            )
+            sys.exit(1)
+
+        # optionally have the homeserver push events to us as an application service, rather than syncing
+        self._appservice = getattr(config, "MATRIX_APPSERVICE", None)
+        if self._appservice and self._e2ee:
+            log.fatal("MATRIX_E2EE doesn't work with MATRIX_APPSERVICE (yet)")
+            sys.exit(1)
+
+        self.startup_time = None
+
+        # set when we're one of ProcessDispatcher's workers, rather than the bot that talks to matrix
+        self._worker = None
+
+        # optional prometheus endpoint, you can also get at them with bot.metrics()
+        self._metrics_host = getattr(config, "MATRIX_METRICS_HOST", "127.0.0.1")
+        self._metrics_port = getattr(config, "MATRIX_METRICS_PORT", None)
+
+        # syncing, and how long we can go without one before we count as unhealthy
+        self._sync = None
+        self._sync_timeout = getattr(config, "MATRIX_SYNC_TIMEOUT", 30000)
+        self._min_backoff = getattr(config, "MATRIX_SYNC_MIN_BACKOFF", 1.0)
+        self._max_backoff = getattr(config, "MATRIX_SYNC_MAX_BACKOFF", 60.0)
+        self._max_lag = getattr(
+            config, "MATRIX_HEALTH_MAX_LAG", self._sync_timeout / 1000 + 60
+        )
+
     def serve_once(self):
         self.loop = asyncio.get_event_loop()
         return self.loop.run_until_complete(self._matrix_loop())
@@ -835,30 +4177,364 @@ class MatrixBackend(ErrBot):
             log.info("Matrix main loop started")
 
             if not self._client:
-                # login
-                self._client = nio.AsyncClient(self.homeserver)
-                self._client.access_token = self.token
-
-                # setup async and call whoami
-                self._async = MatrixBackendAsync(self, self._client)
-                self.bot_identifier = await self._async.whoami()
-                self._client.user = self.bot_identifier._id
-
-                # sync so we don't get the stuff from history
-                result = await self._client.sync(full_state=True)
-                if isinstance(result, nio.responses.ErrorResponse):
-                    raise ValueError(result)
+                await self._start()
+
+                if self._metrics_port:
+                    await self._serve_metrics()
+                if self._async.tracer:
+                    asyncio.ensure_future(self._async.tracer.run())
+
+                if self._appservice:
+                    self._sync = AppServiceListener(
+                        self._client,
+                        self._appservice["hs_token"],
+                        host=self._appservice.get("host", "127.0.0.1"),
+                        port=self._appservice.get("port", 8009),
+                    )
+                else:
+                    self._sync = SyncLoop(
+                        self._client,
+                        timeout=self._sync_timeout,
+                        sync_filter=self._async.sync_filter,
+                        min_backoff=self._min_backoff,
+                        max_backoff=self._max_backoff,
+                        crypto=self._async.crypto,
+                    )
+                METRICS.add_collector(self._collect_sync_metrics)
 
                 log.debug("bot now in event loop - waiting on messages")
                 self._async.attach_callbacks()
                 self.connect_callback()
+                if self._async.processes:
+                    self._async.processes.start()
 
-            await self._client.sync_forever(timeout=150)
+            await self._sync.run()
             return False
         except (KeyboardInterrupt, StopIteration):
+            await self._close()
             self.disconnect_callback()
             return True
 
+    async def _start(self) -> None:
+        """Log in and catch up with the homeserver, backing off and trying again until that works.
+
+        Nothing is kept from an attempt that failed, so each one starts with a new client.
+        """
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                result = await self._connect()
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                await self._drop_client()
+                delay = backoff_delay(failures, self._min_backoff, self._max_backoff)
+                log.warning(
+                    "couldn't connect to matrix (%d in a row): %s, retry in %.1fs",
+                    failures,
+                    e,
+                    delay,
+                )
+                await asyncio.sleep(delay)
+
+        if self._state_store:
+            self._state_store.save(result)
+            self._client.add_response_callback(
+                self._on_sync, nio.responses.SyncResponse
+            )
+
+        self.startup_time = time.monotonic() - started
+        log.info(
+            "initial sync of %d rooms took %.2fs (state store: %s)",
+            len(self._client.rooms),
+            self.startup_time,
+            "on" if self._state_store else "off",
+        )
+
+        await self._async.build_indexes(
+            result,
+            self._state_store.canonical_aliases() if self._state_store else None,
+        )
+
+    async def _connect(self) -> nio.responses.SyncResponse:
+        # login
+        self._client = MatrixClient(self.homeserver, config=self._client_config())
+        self._client.client_session = self._http_session()
+        self._client.access_token = self.token
+
+        # setup async and call whoami
+        self._async = MatrixBackendAsync(self, self._client)
+        self.bot_identifier = await self._async.whoami()
+        self._client.user = self.bot_identifier._id
+        if self._e2ee:
+            self._load_crypto_store()
+
+        # sync so we don't get the stuff from history
+        result = await self._initial_sync()
+        if isinstance(result, nio.responses.ErrorResponse):
+            raise ValueError(result)
+        return result
+
+    async def _drop_client(self) -> None:
+        """Throw away a client that didn't get going, so the next attempt starts from scratch."""
+        if self._async is not None:
+            await self._async.close()
+        if self._client is not None:
+            await self._client.close()
+        self._async = None
+        self._client = None
+
+    async def _close(self) -> None:
+        METRICS.remove_collector(self._collect_sync_metrics)
+        if self._async:
+            await self._async.close()
+
+    def shutdown(self) -> None:
+        # an interrupt usually stops the event loop from outside _matrix_loop, so tidy up here too
+        if self.loop is not None:
+            try:
+                if self.loop.is_running():
+                    asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(
+                        30
+                    )
+                else:
+                    self.loop.run_until_complete(self._close())
+            except Exception:
+                log.exception("error shutting down the matrix backend")
+        super().shutdown()
+
+    def serve_worker(self, snapshot: dict, index: int, jobs, results, replies) -> None:
+        """Run as one of ProcessDispatcher's workers, handling the messages it gives us until told to stop.
+
+        We never connect to matrix, rooms are rebuilt from the snapshots that come with each message and
+        anything we send is handed back to the main process to send. Everything we store is stored there
+        too, and plugins here only handle messages."""
+        self._worker = (index, results, replies)
+        self._storage_calls = itertools.count()
+        self._storage_lock = threading.Lock()
+        self.loop = None
+        self._client = nio.Client(
+            snapshot["user_id"], config=nio.ClientConfig(encryption_enabled=False)
+        )
+        self.bot_identifier = MatrixPerson(snapshot["user_id"])
+
+        # errbot opened its own stores (in memory) while starting up, swap them for the main process's
+        storage = WorkerStoragePlugin(self.bot_config, self._storage_call)
+        for owner in (self, self.plugin_manager, self.repo_manager):
+            namespace = owner.namespace
+            owner.close_storage()
+            owner.open_storage(storage, namespace)
+        self.storage_plugin = storage
+
+        plugins = self.plugin_manager
+        if snapshot["repos"]:
+            plugins.update_plugin_places(snapshot["repos"])
+        for plugin in plugins.plugins.values():
+            self._dispatch_only(plugin)
+        plugins.activate_non_started_plugins()
+        results.put((index, "ready", None))
+
+        parent = multiprocessing.parent_process()
+        while True:
+            try:
+                item = jobs.get(timeout=1)
+            except queue.Empty:
+                # if the bot went away without telling us, so do we
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            if item is None:
+                break
+
+            job, data = item
+            results.put((index, "start", job))
+            try:
+                self.callback_message(decode_value(data, self._snapshot_room))
+            except Exception:
+                log.exception("error handling a message in dispatch worker %d", index)
+            finally:
+                results.put((index, "done", job))
+        self.disconnect_callback()
+
+    @staticmethod
+    def _dispatch_only(plugin: BotPlugin) -> None:
+        """Keep a worker's copy of a plugin to handling messages, the main process runs everything else."""
+        plugin.callback_connect = lambda: None
+        plugin.program_next_poll = lambda *args, **kwargs: None
+        if plugin.name == "Webserver":
+            # its commands still work without the server, which is already listening in the main process
+            plugin.activate = functools.partial(BotPlugin.activate, plugin)
+
+    def _storage_call(self, namespace: str, method: str, *args):
+        """Ask the main process to do something to one of its stores, and wait for the answer."""
+        index, results, replies = self._worker
+        parent = multiprocessing.parent_process()
+        with self._storage_lock:
+            call = (os.getpid(), next(self._storage_calls))
+            results.put((index, "storage", (call, namespace, method, args)))
+            while True:
+                try:
+                    answered, error, value = replies.get(timeout=1)
+                except queue.Empty:
+                    if parent is not None and not parent.is_alive():
+                        raise RuntimeError("the bot went away")
+                    continue
+                # anything else was for a worker that died before it got its answer
+                if answered == call:
+                    break
+        if error is not None:
+            raise error
+        return value
+
+    def _snapshot_room(self, room_id: str, details) -> MatrixRoom:
+        """Rebuild a room from what the main process told us about it (see encode_room)."""
+        if details is not None:
+            name, alias, topic, (joined, invited, heroes), levels, users = details
+            room = nio.MatrixRoom(room_id, self._client.user)
+            room.name = name
+            room.canonical_alias = alias
+            room.topic = topic
+            room.summary = nio.RoomSummary(invited, joined, heroes)
+            room.power_levels.users = dict(levels)
+            for user_id, display_name in users:
+                room.add_member(user_id, display_name, None)
+            self._client.rooms[room_id] = room
+        return MatrixRoom(room_id, self._client, self)
+
+    def _forward(self, method: str, *args, **kwargs) -> None:
+        """Ask the main process to do something for us, see ProcessDispatcher.FORWARDED."""
+        index, results, _ = self._worker
+        args = tuple(encode_value(arg) for arg in args)
+        kwargs = {key: encode_value(value) for key, value in kwargs.items()}
+        results.put((index, "call", (method, args, kwargs)))
+
+    def _room(self, room_id: str) -> MatrixRoom:
+        if self._worker is not None:
+            return MatrixRoom(room_id, self._client, self)
+        return self._async.get_room(room_id)
+
+    def _client_config(self) -> nio.AsyncClientConfig:
+        crypto = dict(encryption_enabled=False)
+        if self._e2ee:
+            crypto = dict(
+                encryption_enabled=True,
+                store=nio.store.SqliteStore,
+                store_name="matrix_crypto.db",
+                pickle_key=getattr(
+                    self.bot_config, "MATRIX_E2EE_PICKLE_KEY", "DEFAULT_KEY"
+                ),
+            )
+        return nio.AsyncClientConfig(
+            request_timeout=getattr(self.bot_config, "MATRIX_REQUEST_TIMEOUT", 60),
+            # nio retries timeouts forever by default, which would keep failed syncs from the sync loop
+            max_timeouts=getattr(self.bot_config, "MATRIX_REQUEST_RETRIES", 2),
+            max_timeout_retry_wait_time=self._max_backoff,
+            # or 429s forever: the send and join queues retry them, after pausing everything they're sending
+            max_limit_exceeded=0,
+            **crypto,
+        )
+
+    def _load_crypto_store(self) -> None:
+        """Open the crypto store for our device, creating our keys the first time we run.
+
+        Keys belong to a device, so the access token needs to stay the same between restarts (logging in
+        again would give us a new device, and everyone would need to share their keys with it again).
+        """
+        if not self._client.device_id:
+            raise ValueError(
+                "MATRIX_E2EE needs a device id, but whoami didn't give us one"
+            )
+
+        started = time.monotonic()
+        self._client.store_path = self.bot_config.BOT_DATA_DIR
+        self._client.load_store()
+        log.info(
+            "loaded crypto store for device %s in %.2fs",
+            self._client.device_id,
+            time.monotonic() - started,
+        )
+
+    def _http_session(self) -> ClientSession:
+        """One HTTP session (and connection pool) for everything we send to the homeserver.
+
+        Connections are kept alive between requests, so we aren't doing a TCP and TLS handshake for
+        every message."""
+        connector = TCPConnector(
+            limit=getattr(self.bot_config, "MATRIX_HTTP_POOL_SIZE", 32),
+            keepalive_timeout=getattr(self.bot_config, "MATRIX_HTTP_KEEPALIVE", 60),
+            ttl_dns_cache=300,
+        )
+        timeout = ClientTimeout(total=self._client.config.request_timeout)
+        return ClientSession(connector=connector, timeout=timeout)
+
+    async def _initial_sync(self):
+        """Catch up with the homeserver before we start processing events.
+
+        If we have a state store with a sync token we rebuild the rooms from that and only ask for what
+        changed since, otherwise (or if the homeserver doesn't like the token) we do a full state sync.
+        """
+        token = self._state_store.load_token() if self._state_store else None
+        sync_filter = await self._async.sync_filter.get()
+        if token:
+            restored = self._state_store.restore(self._client)
+            log.info("restored %d rooms from the state store", restored)
+
+            result = await self._client.sync(since=token, sync_filter=sync_filter)
+            if not isinstance(result, nio.responses.ErrorResponse):
+                return result
+
+            log.warning("couldn't resume from stored sync token: %s", result)
+            self._state_store.clear()
+            self._client.rooms.clear()
+
+        return await self._client.sync(full_state=True, sync_filter=sync_filter)
+
+    async def _serve_metrics(self) -> None:
+        """Serve the metrics over HTTP, for prometheus to scrape."""
+
+        async def handler(request):
+            return web.Response(text=METRICS.render(), content_type="text/plain")
+
+        async def health(request):
+            return web.json_response(
+                {"healthy": self.healthy(), "sync_lag": self.sync_lag()},
+                status=200 if self.healthy() else 503,
+            )
+
+        app = web.Application()
+        app.router.add_get("/metrics", handler)
+        app.router.add_get("/health", health)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, self._metrics_host, self._metrics_port).start()
+        log.info(
+            "serving metrics on http://%s:%s/metrics",
+            self._metrics_host,
+            self._metrics_port,
+        )
+
+    def metrics(self) -> dict:
+        """Get the backend's metrics, keyed by (name, labels)."""
+        return METRICS.snapshot()
+
+    def sync_lag(self) -> Optional[float]:
+        """Seconds since we last heard from the homeserver (None if we haven't started syncing)."""
+        return self._sync.lag() if self._sync else None
+
+    def healthy(self) -> bool:
+        """Are we keeping up with the homeserver?"""
+        lag = self.sync_lag()
+        return lag is not None and lag < self._max_lag
+
+    def _collect_sync_metrics(self) -> dict:
+        return {("matrix_sync_" + k, ()): v for k, v in self._sync.stats().items()}
+
+    async def _on_sync(self, response: nio.responses.SyncResponse) -> None:
+        self._state_store.save(response)
+
     def build_identifier(self, txt: str):
         log.debug("getting identifier for: %s", txt)
         if txt[0] == "@":
@@ -867,13 +4543,71 @@ class MatrixBackend(ErrBot):
             return person
         elif txt[0] == "!":
             if txt in self._client.rooms:
-                return MatrixRoom(txt, self._client)
+                return self._room(txt)
         elif txt[0] == "#":
-            for room in self._client.rooms.values():
-                if room.canonical_alias == txt:
-                    return MatrixRoom(room.room_id, self._client)
+            room_id = self._resolve_alias(txt)
+            if room_id:
+                return self._room(room_id)
         return None
 
+    def inject_commands_from(self, instance_to_inject):
+        super().inject_commands_from(instance_to_inject)
+        if self._async is not None:
+            self._async.plugins_changed()
+
+    def remove_commands_from(self, instance_to_inject) -> None:
+        super().remove_commands_from(instance_to_inject)
+        if self._async is not None:
+            self._async.plugins_changed()
+
+    def _on_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _resolve_alias(self, alias: str) -> Optional[str]:
+        """Find the room id for an alias.
+
+        Rooms we're in come from the alias index. For anything else we need to ask the homeserver, which we
+        can only wait for if we're not on the event loop's thread. Workers only know the rooms they've seen.
+        """
+        if self._worker is not None:
+            rooms = self._client.rooms.values()
+            return next((r.room_id for r in rooms if r.canonical_alias == alias), None)
+
+        room_id = self._async.room_for_alias(alias)
+        if room_id or self._on_loop_thread():
+            return room_id
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._async.resolve_alias(alias), loop=self.loop
+        )
+        return future.result(timeout=30)
+
+    def load_member(self, room_id: str, user_id: str) -> bool:
+        """Fetch a room member we haven't seen yet, returns False if they aren't in the room.
+
+        On the event loop's thread we can't wait for the homeserver, so this gives up straight away.
+        """
+        if self._worker is not None or self._on_loop_thread():
+            return False
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._async.load_member(room_id, user_id), loop=self.loop
+        )
+        return future.result(timeout=30)
+
+    def load_members(self, room_id: str) -> None:
+        """Fetch the full member list for a room, if we can wait for it."""
+        if self._worker is not None or self._on_loop_thread():
+            return
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._async.load_members(room_id), loop=self.loop
+        )
+        future.result(timeout=60)
+
     def build_message(self, txt):
         return MatrixMessage(body=txt)
 
@@ -888,6 +4622,7 @@ class MatrixBackend(ErrBot):
 
         response = self.build_message(text)
         response.frm = self.bot_identifier
+        response._trace = getattr(msg, "_trace", None)
 
         if private and not msg.to.is_private:
             # if it's private, and the room it's private, redirect to the user's management channel
@@ -901,26 +4636,73 @@ class MatrixBackend(ErrBot):
         pass
 
     def send_message(self, msg: backend.Message):
+        """Queue a message to be sent.
+
+        This doesn't wait for the message to be delivered. If you care, the returned future resolves to the
+        nio response once it has been (eg, `bot.send_message(msg).result(timeout=10)`). In a dispatch worker
+        it's handed to the main process to send, and there's nothing to wait for."""
+        if self._worker is not None:
+            return self._forward("send_message", msg)
+
         super().send_message(msg)
         log.info("sending message...")
-        future = asyncio.run_coroutine_threadsafe(
+        return asyncio.run_coroutine_threadsafe(
             self._async.send_message(msg), loop=self.loop
         )
-        log.info("message submitted, result: %s", future.done)
 
-    #        return future.result()
+    def broadcast(self, msg, targets=None, concurrency: int = None):
+        """Send the same message to many rooms at once.
+
+        `msg` can be a message or just the text, `targets` are rooms, people or their ids (all the rooms
+        we're in if not given). The returned future resolves to a summary of what happened in each room,
+        see MatrixBackendAsync.broadcast. Plugins' callback_botmessage is called for each target.
+        """
+        if self._worker is not None:
+            return self._forward("broadcast", msg, targets, concurrency)
+
+        if isinstance(msg, str):
+            msg = self.build_message(msg)
+        targets = list(self.rooms() if targets is None else targets)
+        if concurrency is None:
+            concurrency = getattr(self.bot_config, "MATRIX_BROADCAST_CONCURRENCY", 16)
+
+        # as if they'd been sent one by one (targets we can't make sense of are reported by the broadcast)
+        for target in targets:
+            to = self.build_identifier(target) if isinstance(target, str) else target
+            if to is not None:
+                sent = msg.clone()
+                sent.to = to
+                super().send_message(sent)
+        return asyncio.run_coroutine_threadsafe(
+            self._async.broadcast(msg, targets, concurrency), loop=self.loop
+        )
 
     def send_image(self, room, image_path):
-        future = asyncio.run_coroutine_threadsafe(
+        if self._worker is not None:
+            return self._forward("send_image", room, image_path)
+        return asyncio.run_coroutine_threadsafe(
             self._async.send_image(room, image_path), loop=self.loop
         )
 
+    def send_file(self, room, source, **kwargs):
+        """Send a file (path, bytes or binary file object) to a room.
+
+        See MatrixBackendAsync.send_file for the options."""
+        if self._worker is not None:
+            return self._forward("send_file", room, source, **kwargs)
+        return asyncio.run_coroutine_threadsafe(
+            self._async.send_file(room, source, **kwargs), loop=self.loop
+        )
+
     def react(self, msg: backend.Message, reaction):
         """React to an existing message.
 
         msg is the message your reacting to, not your response!"""
+        if self._worker is not None:
+            return self._forward("react", msg, reaction)
+
         log.info("sending reaction...")
-        asyncio.run_coroutine_threadsafe(
+        return asyncio.run_coroutine_threadsafe(
             self._async.send_reaction(msg, reaction), loop=self.loop
         )
 
@@ -935,18 +4717,32 @@ class MatrixBackend(ErrBot):
         log.info(f"{self._client.rooms.keys()}")
         return self.build_identifier(room)
 
-    async def _mtx_rooms(self) -> list:
-        resp = await self._client.joined_rooms()
-
-        rooms = []
-        if isinstance(resp, nio.responses.JoinedRoomsResponse):
-            for room_id in resp.rooms:
-                mtx_room = self._client.rooms[room_id]
-                if not mtx_room.is_group:
-                    rooms.append(self.build_identifier(room_id))
+    def rooms(self):
+        """The (group) rooms we're in, from our sync state."""
+        return [
+            self._room(room_id)
+            for room_id, room in list(self._client.rooms.items())
+            if not room.is_group
+        ]
+
+
+def run_dispatch_worker(
+    settings: dict, snapshot: dict, index: int, jobs, results, replies
+):
+    """Where ProcessDispatcher's worker processes start."""
+    from errbot.bootstrap import setup_bot
+
+    try:
+        bot = setup_bot(
+            settings.get("BACKEND", "Matrix"),
+            logging.getLogger(),
+            SimpleNamespace(**settings),
+        )
+        bot.serve_worker(snapshot, index, jobs, results, replies)
+    except KeyboardInterrupt:
+        pass
 
-        return rooms
 
-    def rooms(self):
-        future = asyncio.run_coroutine_threadsafe(self._mtx_rooms(), loop=self.loop)
-        return future.result()
+if __name__ == "__matrix_worker__":
+    # we've been started as a dispatch worker, see ProcessDispatcher._spawn
+    run_dispatch_worker(*WORKER_ARGS)  # noqa: F821